@@ -0,0 +1,82 @@
+import math
+
+SUMMARY_FIELDS = ('temperature', 'pressure', 'altitude')
+
+
+class FieldStats:
+    # Welford's online mean/variance plus min/max.
+    __slots__ = ('n', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, v):
+        self.n += 1
+        delta = v - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (v - self.mean)
+        if v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+    def as_dict(self):
+        return {
+            'min': self.min,
+            'max': self.max,
+            'variance': self.m2 / self.n if self.n else 0.0,
+        }
+
+
+class SummaryAccumulator:
+    # Running totals for one drone between two summary flushes. Memory is
+    # fixed regardless of how many readings arrive, and averages come out
+    # bit-for-bit equal to summing the readings in arrival order.
+    __slots__ = ('count', 'sums', 'counts', 'motor_sums', 'stats')
+
+    def __init__(self, track_stats=False):
+        self.count = 0
+        self.sums = [0.0] * len(SUMMARY_FIELDS)
+        self.counts = [0] * len(SUMMARY_FIELDS)
+        self.motor_sums = None
+        self.stats = [FieldStats() for _ in SUMMARY_FIELDS] if track_stats else None
+
+    def add(self, r):
+        self.count += 1
+        sums = self.sums
+        counts = self.counts
+        stats = self.stats
+        for i, field in enumerate(SUMMARY_FIELDS):
+            v = r.get(field)
+            if v is None:
+                continue
+            sums[i] += v
+            counts[i] += 1
+            if stats is not None:
+                stats[i].add(v)
+
+        motors = r.get('motor_energies')
+        if motors is None:
+            return
+        if self.motor_sums is None:
+            self.motor_sums = [0] * len(motors)
+        ms = self.motor_sums
+        for i, m in enumerate(motors[:len(ms)]):
+            ms[i] += m
+
+    def averages(self):
+        avgs = {
+            f'avg_{field}': self.sums[i] / self.counts[i] if self.counts[i] else None
+            for i, field in enumerate(SUMMARY_FIELDS)
+        }
+        avgs['avg_motor_energies'] = [m / self.count for m in self.motor_sums or []]
+        return avgs
+
+    def stats_dict(self):
+        if self.stats is None:
+            return None
+        return {field: self.stats[i].as_dict() for i, field in enumerate(SUMMARY_FIELDS) if self.stats[i].n}
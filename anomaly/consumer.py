@@ -2,169 +2,612 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import threading
+import multiprocessing
+import queue as queue_mod
 import time
 import json
-from collections import defaultdict, deque
+import math
+from collections import OrderedDict
 from datetime import datetime
-from comm.central_client import send_to_central
-from comm.battery_manager import (
-    update_time_drain,
-    drain_on_read,
-    drain_on_send,
-    get_level,
-    check_return_to_base,
-    should_enqueue
-)
-from logger import setup_logger
-
-WINDOW = 2.0
+from comm import uplink
+from comm import central_client
+from comm.readings import drone_id_of, shard_of
+from anomaly.window import MonotonicWindow
+from anomaly.aggregates import SummaryAccumulator
+from anomaly.rules import load_rules
+from anomaly.detectors import SensorDetectors
+from anomaly.event_time import EventTimeGate, REORDER_DELAY, ALLOWED_LATENESS
+from anomaly.scheduler import FlushScheduler, TICK
+from anomaly import snapshot
+from anomaly.state import DroneStates, BatteryCheckpoints, DRONE_TTL, MAX_DRONES, MAX_OPEN_LOGS
+from comm.battery_manager import BatteryBank, CRITICAL_LEVEL, RETURN_LEVEL, RETURN_TO_BASE
+import logger as log_config
+from logger import setup_logger, console, release_files, close_logger
+
+# Summaries cover aligned event-time buckets of this many seconds.
 BATCH_INTERVAL = 2.0
+SHARD_QUEUE_SIZE = 10000
+# How often shards release readings held for drones that went quiet.
+TICK_INTERVAL = 0.5
+# Add min/max/variance per field to each summary (Welford, O(1) per reading).
+SUMMARY_STATS = False
+
+# Ranges, window spreads and compound rules live in anomaly/rules.json
+# (or the file given with --rules), compiled once when loaded.
+rule_engine = load_rules()
+rules_path = None
 
-buffers = defaultdict(lambda: deque())
-summary_buffers = defaultdict(list)
-drone_loggers = {}
+# Per-drone state is dropped after DRONE_TTL seconds without readings, or
+# least recently used first once a shard holds MAX_DRONES (0 = no limit).
+# At most MAX_OPEN_LOGS drone log files stay open; older ones are closed
+# and reopened when written to again. Battery state of evicted drones is
+# kept in BATTERY_CHECKPOINTS (a directory) if set, and restored when the
+# drone comes back.
+drone_ttl = DRONE_TTL
+max_drones = MAX_DRONES
+max_open_logs = MAX_OPEN_LOGS
+battery_checkpoints = None
+# 'bank' (drain on readings) or 'fleet' (NumPy arrays, drained every tick).
+battery_engine = 'bank'
+
+drone_loggers = OrderedDict()
+drone_loggers_lock = threading.Lock()
+log_files_released = 0
 anomaly_logger = setup_logger('anomalies', 'logs/anomalies.log')
+consumer_logger = setup_logger('consumer', 'logs/server/consumer.log')
 
 def get_drone_logger(drone_id):
-    if not drone_id.startswith("drone"):
-        print("⚠️ Invalid drone_id:", drone_id)
+    global log_files_released
+    with drone_loggers_lock:
+        logger = drone_loggers.get(drone_id)
+        if logger is not None:
+            drone_loggers.move_to_end(drone_id)
+            return logger
+
+        if not drone_id.startswith("drone"):
+            console("⚠️ Invalid drone_id:", drone_id)
+        console("🔍 Creating logger for:", drone_id)
+        logger = drone_loggers[drone_id] = setup_logger(drone_id, f'logs/drones/{drone_id}.log')
+        while max_open_logs and len(drone_loggers) > max_open_logs:
+            oldest, _ = drone_loggers.popitem(last=False)
+            release_files(oldest)
+            log_files_released += 1
+        return logger
 
-    if drone_id not in drone_loggers:
-        print("🔍 Creating logger for:", drone_id)
-        drone_loggers[drone_id] = setup_logger(drone_id, f'logs/drones/{drone_id}.log')
-    return drone_loggers[drone_id]
+def forget_drone_logger(drone_id):
+    with drone_loggers_lock:
+        drone_loggers.pop(drone_id, None)
+        close_logger(drone_id)
+
+def configure_state(ttl=DRONE_TTL, max_per_shard=MAX_DRONES, open_logs=MAX_OPEN_LOGS, checkpoint_dir=None,
+                    engine='bank'):
+    global drone_ttl, max_drones, max_open_logs, battery_checkpoints, battery_engine
+    drone_ttl = ttl
+    max_drones = max_per_shard
+    max_open_logs = open_logs
+    battery_checkpoints = BatteryCheckpoints(checkpoint_dir) if checkpoint_dir else None
+    battery_engine = engine
+
+def make_battery_bank():
+    if battery_engine == 'fleet':
+        from comm.fleet_battery import FleetBattery
+        return FleetBattery()
+    return BatteryBank()
 
 def parse_timestamp(ts_str):
     try:
         return datetime.fromisoformat(ts_str.replace('Z', '+00:00')).timestamp()
     except Exception:
-        return time.time()
+        return None
+
+def set_rules(path):
+    global rule_engine, rules_path
+    rule_engine = load_rules(path)
+    rules_path = path
 
 def detect_threshold_anomalies(r):
-    anomalies = []
+    return rule_engine.default.check(r)
 
-    t = r.get('temperature')
-    if t is not None and (t < -10 or t > 60):
-        anomalies.append({'type': 'temperature', 'value': t})
+class WindowBuffers(dict):
+    # Per-drone discrepancy windows, created with that drone's span and
+    # spread limits from the rule file.
 
-    p = r.get('pressure')
-    if p is not None and (p < 300 or p > 1100):
-        anomalies.append({'type': 'pressure', 'value': p})
+    def __missing__(self, drone_id):
+        rule = rule_engine.profile(drone_id).window
+        window = self[drone_id] = MonotonicWindow(rule.span, rule.limits)
+        return window
 
-    alt = r.get('altitude')
-    if alt is not None and (alt < 0 or alt > 500):
-        anomalies.append({'type': 'altitude', 'value': alt})
+class ConsumerShard:
+    # Owns the anomaly windows and pending summaries for the drones hashed
+    # to it. A drone only ever lands on one shard, so shards never share
+    # state and per-drone ordering is kept by feeding each shard from a
+    # single FIFO.
 
-    motors = r.get('motor_energies')
-    if motors:
-        for idx, m in enumerate(motors):
-            if m < 0 or m > 100:
-                anomalies.append({'type': f'motor_{idx}', 'value': m})
+    def __init__(self, index=0, reorder_delay=REORDER_DELAY, allowed_lateness=ALLOWED_LATENESS):
+        self.index = index
+        self.buffers = WindowBuffers()
+        self.summary_buffers = {}
+        self.summary_lock = threading.Lock()
+        # Held by the shard's thread for each item and tick, so a snapshot
+        # can pause it between readings.
+        self.work_lock = threading.Lock()
+        self.detectors = None
+        self.gate = EventTimeGate(reorder_delay, allowed_lateness)
+        self.flushes = FlushScheduler(lambda drone_id: rule_engine.profile(drone_id).flush.interval,
+                                      lambda drone_id: rule_engine.profile(drone_id).flush.jitter,
+                                      now=time.time())
+        self.states = DroneStates(drone_ttl, max_drones)
+        self.batteries = make_battery_bank()
 
-    return anomalies
+    def detect_discrepancy_anomalies(self, drone_id, ts):
+        window = self.buffers[drone_id]
+        window.expire(ts)
+        rule = rule_engine.profile(drone_id).window
 
-def detect_discrepancy_anomalies(drone_id, ts):
-    buf = buffers[drone_id]
-    while buf and buf[0][0] < ts - WINDOW:
-        buf.popleft()
-
-    anomalies = []
-    if len(buf) >= 4:
-        temps = [r['temperature'] for _, r in buf if 'temperature' in r]
-        alts  = [r['altitude']    for _, r in buf if 'altitude'    in r]
-        if temps and (max(temps) - min(temps) > 5):
-            anomalies.append({'type': 'temperature_discrepancy', 'range': max(temps) - min(temps)})
-        if alts and (max(alts) - min(alts) > 1):
-            anomalies.append({'type': 'altitude_discrepancy', 'range': max(alts) - min(alts)})
-    return anomalies
+        anomalies = []
+        if len(window) >= rule.min_readings:
+            for field, limit in rule.limits.items():
+                spread = window.range(field)
+                if spread is not None and spread > limit:
+                    anomalies.append({'type': f'{field}_discrepancy', 'range': spread})
+        return anomalies
 
-def handle_reading(r: dict):
-    ts = parse_timestamp(r.get('timestamp', ''))
-    sensor_id = r.get('sensor_id', '')
-    drone_id = r.get('drone_id') or '_'.join(sensor_id.split('_')[:2])
+    def statistical_detectors(self):
+        # The detectors for the current rule file, or None if it disables them.
+        config = rule_engine.detectors
+        if config is None:
+            return None
+        if self.detectors is None or self.detectors.config is not config:
+            self.detectors = SensorDetectors(config)
+        return self.detectors
+
+    def detect_statistical_anomalies(self, r, ts):
+        detectors = self.statistical_detectors()
+        if detectors is None:
+            return []
+        return detectors.update(r.get('sensor_id', ''), ts, r)
+
+    def event_time(self, r):
+        ts = r.get('epoch')
+        if type(ts) is not float or not math.isfinite(ts):
+            ts = parse_timestamp(r.get('timestamp', ''))
+        if ts is None:
+            self.gate.bad_timestamps += 1
+            consumer_logger.warning(f"Dropping reading from {r.get('sensor_id')} with bad timestamp "
+                                    f"{r.get('timestamp')!r}")
+        return ts
+
+    def hold(self, r, released):
+        # Hold the reading in the event-time gate; whatever it lets through
+        # (possibly earlier readings of the same drone) is appended to
+        # released as (reading, event time, drone_id, late).
+        ts = self.event_time(r)
+        if ts is None:
+            return
+        released.extend(self.gate.offer(drone_id_of(r), ts, r, time.time()))
+
+    def drain(self, released):
+        # Battery drain for everything released at once, one drain_batch per
+        # drone. Returns (accepted, level) for each item of released.
+        now = time.time()
+        runs = {}
+        for i, (r, ts, drone_id, late) in enumerate(released):
+            if self.states.touch(drone_id, r.get('sensor_id', ''), now) and battery_checkpoints is not None:
+                state = battery_checkpoints.load(drone_id)
+                if state is not None:
+                    self.batteries.import_state(drone_id, state)
+                    self.states.restored += 1
+            runs.setdefault(drone_id, []).append(i)
+        results = [None] * len(released)
+        for drone_id, indices in runs.items():
+            drained = self.batteries.drain_batch(drone_id, [(released[i][1], released[i][3]) for i in indices])
+            for i, result in zip(indices, drained):
+                results[i] = result
+        return results
+
+    def admit(self, r, ts, drone_id, battery):
+        # Summary accounting shared by the per-reading and the vectorized
+        # batch paths, given the reading's (accepted, level) from drain().
+        # Returns None if the reading is dropped.
+        logger = get_drone_logger(drone_id)
+        accepted, level = battery
+        if not accepted:
+            logger.warning(f"Battery critical ({level:.1f}%), dropping reading")
+            return None
 
-    print("🔍 LOGGING FOR DRONE ID:", drone_id)
-    logger = get_drone_logger(drone_id)
+        if level < CRITICAL_LEVEL:
+            r['motor_energies'] = [0] * len(r.get('motor_energies', []))
 
-    update_time_drain(drone_id, ts)
+        bucket = math.floor(ts / BATCH_INTERVAL) * BATCH_INTERVAL
+        with self.summary_lock:
+            buckets = self.summary_buffers.get(drone_id)
+            if buckets is None:
+                buckets = self.summary_buffers[drone_id] = {}
+                self.flushes.arm(drone_id, time.time())
+            acc = buckets.get(bucket)
+            if acc is None:
+                acc = buckets[bucket] = SummaryAccumulator(SUMMARY_STATS)
+            acc.add(r)
+        return logger
+
+    def report(self, r, logger, all_anoms):
+        sensor_id = r.get('sensor_id', '')
+        if all_anoms:
+            logger.warning(f"Anomalies detected: {json.dumps(all_anoms)}")
+            anomaly_logger.warning(f"{sensor_id} @ {r['timestamp']} → {json.dumps(all_anoms)}")
+        else:
+            logger.info(f"Reading accepted from {sensor_id} at {r.get('timestamp')}")
+
+    def process(self, r, ts, drone_id, late, battery):
+        logger = self.admit(r, ts, drone_id, battery)
+        if logger is None:
+            return
+
+        threshold_anoms = rule_engine.profile(drone_id).check(r)
+        if late:
+            # Behind the watermark: the window has already moved past it.
+            discrepancy_anoms = []
+        else:
+            self.buffers[drone_id].push(ts, r)
+            discrepancy_anoms = self.detect_discrepancy_anomalies(drone_id, ts)
+        statistical_anoms = self.detect_statistical_anomalies(r, ts)
+        self.report(r, logger, threshold_anoms + discrepancy_anoms + statistical_anoms)
+
+    def process_released(self, released):
+        for item, battery in zip(released, self.drain(released)):
+            self.process(*item, battery)
+
+    def handle_reading(self, r: dict):
+        released = []
+        self.hold(r, released)
+        self.process_released(released)
+
+    def handle_batch(self, readings):
+        released = []
+        for r in readings:
+            self.hold(r, released)
+        self.process_released(released)
+
+    def handle_item(self, item):
+        if isinstance(item, list):
+            self.handle_batch(item)
+        else:
+            self.handle_reading(item)
+
+    def tick(self, now):
+        released = self.gate.expire_idle(now)
+        if released:
+            self.process_released(released)
+        for drone_id, event, level in self.batteries.tick(now):
+            logger = get_drone_logger(drone_id)
+            if event == RETURN_TO_BASE:
+                logger.warning(f"Return-to-base triggered at {level:.1f}%")
+            else:
+                logger.warning(f"Battery critical ({level:.1f}%), readings will be dropped")
+        self.evict_idle(now)
+
+    def evict_idle(self, now):
+        # Idle drones only go once their summaries are out; drones over the
+        # max_drones budget go regardless, their open buckets sent early.
+        for drone_id in self.states.expired(now):
+            with self.summary_lock:
+                busy = drone_id in self.summary_buffers
+            if not busy and self.gate.idle(drone_id, now):
+                self.evict(drone_id)
+                self.states.evicted_idle += 1
+        overflow = self.states.overflow()
+        if overflow:
+            for drone_id in overflow:
+                released = self.gate.release_drone(drone_id)
+                if released:
+                    self.process_released(released)
+            send_summaries(self.collect_summaries(math.inf, overflow))
+            for drone_id in overflow:
+                self.evict(drone_id)
+                self.states.evicted_lru += 1
+
+    def evict(self, drone_id):
+        sensors = self.states.remove(drone_id)
+        self.buffers.pop(drone_id, None)
+        if self.detectors is not None:
+            for sensor_id in sensors:
+                self.detectors.forget(sensor_id)
+        self.gate.forget(drone_id)
+        with self.summary_lock:
+            self.summary_buffers.pop(drone_id, None)
+            self.flushes.cancel(drone_id)
+        state = self.batteries.export_state(drone_id)
+        if state is not None and battery_checkpoints is not None:
+            battery_checkpoints.save(drone_id, state)
+            self.states.checkpointed += 1
+        forget_drone_logger(drone_id)
+
+    def due_flushes(self, now):
+        with self.summary_lock:
+            return self.flushes.due(now)
+
+    def collect_summaries(self, now, drone_ids=None):
+        # A bucket is complete once the drone's watermark is past its end
+        # plus the allowed lateness, or once the drone has gone idle. Drones
+        # that still have open buckets go back on the flush wheel.
+        lateness = self.gate.allowed_lateness
+        closed = []
+        with self.summary_lock:
+            for drone_id in list(self.summary_buffers) if drone_ids is None else drone_ids:
+                buckets = self.summary_buffers.get(drone_id)
+                if buckets is None:
+                    continue
+                limit = self.gate.watermark(drone_id) - lateness - BATCH_INTERVAL
+                idle = self.gate.idle(drone_id, now)
+                for bucket in sorted(buckets):
+                    if idle or bucket <= limit:
+                        closed.append((drone_id, bucket, buckets.pop(bucket)))
+                if buckets:
+                    self.flushes.arm(drone_id, now)
+                else:
+                    del self.summary_buffers[drone_id]
+                    self.flushes.cancel(drone_id)
 
-    if not should_enqueue(drone_id):
-        logger.warning(f"Battery critical ({get_level(drone_id):.1f}%), dropping reading")
+        outgoing = []
+        for drone_id, bucket, acc in closed:
+            logger = get_drone_logger(drone_id)
+            avgs = acc.averages()
+            avg_motors = avgs['avg_motor_energies']
+
+            return_evt, lvl = self.batteries.check_return_to_base(drone_id)
+            if return_evt:
+                logger.warning(f"Return-to-base triggered at {lvl:.1f}%")
+
+            if lvl < RETURN_LEVEL:
+                logger.warning(f"Battery low ({lvl:.1f}%), skipping summary")
+            else:
+                new_lvl = self.batteries.drain_on_send(drone_id, sum(avg_motors) / len(avg_motors) if avg_motors else 0.0)
+                payload = {
+                    "drone_id": drone_id,
+                    "avg_temperature": avgs['avg_temperature'],
+                    "avg_pressure": avgs['avg_pressure'],
+                    "avg_altitude": avgs['avg_altitude'],
+                    "avg_motor_energies": avg_motors,
+                    "timestamp": datetime.utcfromtimestamp(bucket).strftime('%Y-%m-%dT%H:%M:%SZ')
+                }
+                if acc.stats is not None:
+                    payload["stats"] = acc.stats_dict()
+                outgoing.append((logger, payload, new_lvl))
+        return outgoing
+
+    def flush_summaries(self, now, drone_ids=None):
+        send_summaries(self.collect_summaries(now, drone_ids))
+
+
+def send_summaries(outgoing):
+    # Everything collected in one flush tick is handed to the uplink stage
+    # together; it never waits on the network (see comm/uplink.py).
+    if not outgoing:
+        return
+    try:
+        uplink.submit([payload for _, payload, _ in outgoing])
+    except Exception as e:
+        for logger, _, _ in outgoing:
+            logger.error(f"Error queueing summary for central: {e}")
         return
+    for logger, payload, new_lvl in outgoing:
+        logger.info(f"Summary queued for central: {json.dumps(payload)}; battery: {new_lvl:.1f}%")
 
-    level_after_read = drain_on_read(drone_id)
-    if level_after_read < 10:
-        r['motor_energies'] = [0] * len(r.get('motor_energies', []))
+default_shard = ConsumerShard()
+buffers = default_shard.buffers
 
-    buffers[drone_id].append((ts, r))
-    summary_buffers[drone_id].append(r)
+def detect_discrepancy_anomalies(drone_id, ts):
+    return default_shard.detect_discrepancy_anomalies(drone_id, ts)
+
+def handle_reading(r: dict):
+    default_shard.handle_reading(r)
 
-    threshold_anoms = detect_threshold_anomalies(r)
-    discrepancy_anoms = detect_discrepancy_anomalies(drone_id, ts)
-    all_anoms = threshold_anoms + discrepancy_anoms
+def event_time_stats(shards=None):
+    totals = {}
+    for shard in shards or [default_shard]:
+        for key, value in shard.gate.stats().items():
+            if key == 'late_by_drone':
+                merged = totals.setdefault(key, {})
+                merged.update(value)
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
 
-    if all_anoms:
-        logger.warning(f"Anomalies detected: {json.dumps(all_anoms)}")
-        anomaly_logger.warning(f"{sensor_id} @ {r['timestamp']} → {json.dumps(all_anoms)}")
-    else:
-        logger.info(f"Reading accepted from {sensor_id} at {r.get('timestamp')}")
+def state_stats(shards=None):
+    totals = {}
+    for shard in shards or [default_shard]:
+        for key, value in shard.states.stats().items():
+            totals[key] = totals.get(key, 0) + value
+    totals['open_logs'] = len(drone_loggers)
+    totals['log_files_released'] = log_files_released
+    return totals
+
+def start_aggregator(shards=None):
+    shards = shards or [default_shard]
 
-def start_aggregator():
     def agg_loop():
+        # Each drone is flushed on its own timer; the loop only wakes up
+        # every wheel tick to collect whichever drones are due.
+        last = None
+        last_state = None
+        next_stats = time.time() + BATCH_INTERVAL
         while True:
-            time.sleep(BATCH_INTERVAL)
+            time.sleep(TICK)
             now = time.time()
-            for drone_id, readings in list(summary_buffers.items()):
-                logger = get_drone_logger(drone_id)
-
-                if not readings:
-                    continue
+            outgoing = []
+            for shard in shards:
+                due = shard.due_flushes(now)
+                if due:
+                    outgoing.extend(shard.collect_summaries(now, due))
+            send_summaries(outgoing)
+            if now < next_stats:
+                continue
+            next_stats = now + BATCH_INTERVAL
 
-                avg_temperature = sum(r['temperature'] for r in readings) / len(readings)
-                avg_pressure    = sum(r['pressure']    for r in readings) / len(readings)
-                avg_altitude    = sum(r['altitude']    for r in readings) / len(readings)
-                avg_motors      = [
-                    sum(r['motor_energies'][i] for r in readings) / len(readings)
-                    for i in range(len(readings[0]['motor_energies']))
-                ]
+            stats = event_time_stats(shards)
+            counters = (stats['reordered'], stats['late_accepted'], stats['late_dropped'],
+                        stats['forced'], stats['bad_timestamps'])
+            if counters != last:
+                consumer_logger.info(
+                    f"Event time: {stats['drones']} drones, {stats['buffered']} buffered, "
+                    f"reordered {stats['reordered']}, late accepted {stats['late_accepted']}, "
+                    f"late dropped {stats['late_dropped']}, forced {stats['forced']}, "
+                    f"bad timestamps {stats['bad_timestamps']}; late by drone: "
+                    f"{json.dumps(stats['late_by_drone'])}")
+                last = counters
 
-                return_evt, lvl = check_return_to_base(drone_id)
-                if return_evt:
-                    logger.warning(f"Return-to-base triggered at {lvl:.1f}%")
-
-                if lvl < 20:
-                    logger.warning(f"Battery low ({lvl:.1f}%), skipping summary")
-                else:
-                    new_lvl = drain_on_send(drone_id, sum(avg_motors) / len(avg_motors))
-                    payload = {
-                        "drone_id": drone_id,
-                        "avg_temperature": avg_temperature,
-                        "avg_pressure": avg_pressure,
-                        "avg_altitude": avg_altitude,
-                        "avg_motor_energies": avg_motors,
-                        "timestamp": datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H:%M:%SZ')
-                    }
-                    try:
-                        send_to_central(payload)
-                        logger.info(f"Summary sent to central: {json.dumps(payload)}; battery: {new_lvl:.1f}%")
-                    except Exception as e:
-                        logger.error(f"Error sending to central: {e}")
-
-                summary_buffers[drone_id].clear()
+            state = state_stats(shards)
+            if state != last_state:
+                consumer_logger.info(
+                    f"Drone state: {state['drones']} drones held, evicted {state['evicted_idle']} idle "
+                    f"and {state['evicted_lru']} over budget, battery checkpointed {state['checkpointed']} "
+                    f"restored {state['restored']}; {state['open_logs']} drone logs open, "
+                    f"{state['log_files_released']} closed for the file budget")
+                last_state = state
 
     t = threading.Thread(target=agg_loop, daemon=True)
     t.start()
 
-def start_consumer(queue):
-    start_aggregator()
-    print("Aggregator thread started")
+def make_shard(index=0, batch_size=0, reorder_delay=REORDER_DELAY, allowed_lateness=ALLOWED_LATENESS):
+    if batch_size > 1:
+        from anomaly.vectorized import VectorizedShard
+        return VectorizedShard(index, reorder_delay, allowed_lateness)
+    return ConsumerShard(index, reorder_delay, allowed_lateness)
+
+def run_shard(shard, q, done=None, batch_size=0):
+    next_tick = time.time() + TICK_INTERVAL
+    while True:
+        now = time.time()
+        if now >= next_tick:
+            try:
+                with shard.work_lock:
+                    shard.tick(now)
+            except Exception as e:
+                consumer_logger.error(f"Shard {shard.index} tick failed with {type(e).__name__}: {e}")
+            next_tick = now + TICK_INTERVAL
+        try:
+            item = q.get(timeout=TICK_INTERVAL)
+        except queue_mod.Empty:
+            continue
+        if batch_size <= 1:
+            try:
+                with shard.work_lock:
+                    shard.handle_item(item)
+            except Exception as e:
+                consumer_logger.error(f"Shard {shard.index} dropped an item after {type(e).__name__}: {e}")
+            if done is not None:
+                done()
+            continue
+
+        # Drain up to batch_size queue items so detection runs over many
+        # readings at once.
+        items = [item]
+        while len(items) < batch_size:
+            try:
+                items.append(q.get_nowait())
+            except queue_mod.Empty:
+                break
+        readings = []
+        for item in items:
+            if isinstance(item, list):
+                readings.extend(item)
+            else:
+                readings.append(item)
+        try:
+            with shard.work_lock:
+                shard.handle_batch(readings)
+        except Exception as e:
+            consumer_logger.error(f"Shard {shard.index} dropped {len(readings)} readings after "
+                                  f"{type(e).__name__}: {e}")
+        if done is not None:
+            for _ in items:
+                done()
+
+def process_settings():
+    # Everything serve() configured that a shard process needs. A child
+    # started with spawn (the default on Windows and macOS) only re-imports
+    # the modules, so none of it would carry over on its own.
+    client = central_client.uplink
+    return {
+        'rules': rules_path,
+        'state': (drone_ttl, max_drones, max_open_logs,
+                  battery_checkpoints.path if battery_checkpoints is not None else None, battery_engine),
+        'central': (client.host, client.port, client.pool_size, central_client.codec.name),
+        'uplink': (uplink.spool_dir, uplink.spool_name, uplink.queue_size),
+        'snapshot': (snapshot.snapshot_dir, snapshot.snapshot_name, snapshot.interval, snapshot.owner,
+                     snapshot.owners),
+        'logging': (log_config.ASYNC, log_config.PRINTS, dict(log_config.limits)),
+    }
+
+def apply_settings(settings):
+    async_mode, prints, limits = settings['logging']
+    log_config.configure(async_mode, prints)
+    for pattern, opts in limits.items():
+        log_config.set_limits(pattern, opts.get('sample'), opts.get('rate'))
+    if settings['rules'] is not None:
+        set_rules(settings['rules'])
+    configure_state(*settings['state'])
+    host, port, pool_size, codec_name = settings['central']
+    central_client.set_codec(codec_name)
+    central_client.configure(host, port, pool_size)
+    uplink.configure(*settings['uplink'])
+    snapshot.configure(*settings['snapshot'])
+
+def run_shard_process(index, q, settings, batch_size=0, reorder_delay=REORDER_DELAY,
+                      allowed_lateness=ALLOWED_LATENESS, workers=1):
+    apply_settings(settings)
+    uplink.configure(uplink.spool_dir, f'{uplink.spool_name}-shard-{index}', uplink.queue_size)
+    shard = make_shard(index, batch_size, reorder_delay, allowed_lateness)
+    snapshot.start([shard], lambda drone_id: shard if shard_of(drone_id, workers) == index else None,
+                   f'-shard-{index}')
+    start_aggregator([shard])
+    run_shard(shard, q, batch_size=batch_size)
 
-    def worker():
+def start_dispatcher(queue, shard_queues):
+    def dispatch_loop():
+        n = len(shard_queues)
         while True:
-            reading = queue.get()
-            handle_reading(reading)
-            queue.task_done()
+            item = queue.get()
+            try:
+                first = item[0] if isinstance(item, list) else item
+                shard_queues[shard_of(drone_id_of(first), n)].put(item)
+            except Exception as e:
+                consumer_logger.error(f"Dispatcher dropped an item after {type(e).__name__}: {e}")
+            finally:
+                queue.task_done()
 
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
-    print("Consumer thread started")
+    threading.Thread(target=dispatch_loop, daemon=True).start()
+
+def start_consumer(queue, workers=1, backend='thread', batch_size=0, reorder_delay=REORDER_DELAY,
+                   allowed_lateness=ALLOWED_LATENESS):
+    global default_shard, buffers
+    if workers <= 1:
+        default_shard = make_shard(0, batch_size, reorder_delay, allowed_lateness)
+        buffers = default_shard.buffers
+        snapshot.start([default_shard], lambda drone_id: default_shard)
+        start_aggregator()
+        console("Aggregator thread started")
+        t = threading.Thread(target=run_shard, args=(default_shard, queue, queue.task_done, batch_size),
+                             daemon=True)
+        t.start()
+        console("Consumer thread started")
+        return
+
+    if backend == 'process':
+        shard_queues = [multiprocessing.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+        for i, q in enumerate(shard_queues):
+            args = (i, q, process_settings(), batch_size, reorder_delay, allowed_lateness, workers)
+            multiprocessing.Process(target=run_shard_process, args=args, daemon=True,
+                                    name=f'consumer-shard-{i}').start()
+        console(f"Started {workers} consumer shard processes")
+    else:
+        shards = [make_shard(i, batch_size, reorder_delay, allowed_lateness) for i in range(workers)]
+        snapshot.start(shards, lambda drone_id: shards[shard_of(drone_id, workers)])
+        shard_queues = [queue_mod.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+        for shard, q in zip(shards, shard_queues):
+            threading.Thread(target=run_shard, args=(shard, q, None, batch_size), daemon=True,
+                             name=f'consumer-shard-{shard.index}').start()
+        start_aggregator(shards)
+        console(f"Started {workers} consumer shard threads")
+
+    start_dispatcher(queue, shard_queues)
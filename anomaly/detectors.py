@@ -0,0 +1,111 @@
+import math
+from array import array
+
+# Per-metric state, packed side by side in one array('d') per sensor.
+N, MEAN, VAR, POS, NEG, LAST, LAST_TS = range(7)
+STRIDE = 7
+
+
+class DetectorConfig:
+    __slots__ = ('fields', 'alpha', 'warmup', 'z_limit', 'cusum_k', 'cusum_h', 'rate')
+
+    def __init__(self, fields=('temperature', 'humidity', 'pressure', 'altitude'), alpha=0.05, warmup=30,
+                 z_limit=4.0, cusum_k=0.5, cusum_h=10.0, rate=None):
+        self.fields = tuple(fields)
+        self.alpha = alpha
+        self.warmup = warmup
+        self.z_limit = z_limit
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        self.rate = dict(rate or {})
+
+
+class SensorDetectors:
+    # O(1)-per-reading statistical detectors for every sensor and metric:
+    #   - EWMA mean/variance, reporting readings more than z_limit standard
+    #     deviations from the running mean,
+    #   - two-sided CUSUM on those z-scores (k = allowed slack, h = decision
+    #     limit, both in standard deviations), reporting slow drift that no
+    #     single reading gives away; the sum resets after it fires,
+    #   - rate of change per second against the optional per-field limit.
+    # Nothing is reported until a metric has seen `warmup` readings. Each
+    # sensor costs one flat array of STRIDE doubles per metric (~250 bytes
+    # for the default four metrics), so thousands of sensors fit in a few MB.
+
+    __slots__ = ('config', 'states')
+
+    def __init__(self, config):
+        self.config = config
+        self.states = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def nbytes(self):
+        return sum(s.itemsize * len(s) for s in self.states.values())
+
+    def update(self, sensor_id, ts, r):
+        cfg = self.config
+        state = self.states.get(sensor_id)
+        if state is None:
+            state = self.states[sensor_id] = array('d', [0.0] * (STRIDE * len(cfg.fields)))
+
+        anomalies = []
+        alpha = cfg.alpha
+        warmup = cfg.warmup
+        z_limit = cfg.z_limit
+        k = cfg.cusum_k
+        h = cfg.cusum_h
+        rates = cfg.rate
+        for i, field in enumerate(cfg.fields):
+            x = r.get(field)
+            if x is None:
+                continue
+            o = i * STRIDE
+            n = state[o + N] + 1
+            state[o + N] = n
+            if n == 1:
+                state[o + MEAN] = x
+                state[o + LAST] = x
+                state[o + LAST_TS] = ts
+                continue
+
+            mean = state[o + MEAN]
+            var = state[o + VAR]
+            diff = x - mean
+            z = diff / math.sqrt(var) if var > 0 else 0.0
+            incr = alpha * diff
+            state[o + MEAN] = mean + incr
+            state[o + VAR] = (1 - alpha) * (var + diff * incr)
+
+            if n > warmup:
+                if z > z_limit or z < -z_limit:
+                    anomalies.append({'type': f'{field}_zscore', 'value': x, 'z': z})
+                pos = state[o + POS] + z - k
+                neg = state[o + NEG] - z - k
+                if pos < 0.0:
+                    pos = 0.0
+                if neg < 0.0:
+                    neg = 0.0
+                if pos > h or neg > h:
+                    anomalies.append({'type': f'{field}_cusum', 'value': x,
+                                      'direction': 'up' if pos > h else 'down'})
+                    pos = neg = 0.0
+                state[o + POS] = pos
+                state[o + NEG] = neg
+
+            # Timestamps only have one-second resolution, so readings from
+            # the same second are folded into the next step.
+            dt = ts - state[o + LAST_TS]
+            if dt > 0:
+                limit = rates.get(field) if rates else None
+                if limit is not None:
+                    rate = (x - state[o + LAST]) / dt
+                    if abs(rate) > limit:
+                        anomalies.append({'type': f'{field}_rate', 'rate': rate})
+                state[o + LAST] = x
+                state[o + LAST_TS] = ts
+        return anomalies
+
+    def forget(self, sensor_id):
+        self.states.pop(sensor_id, None)
@@ -0,0 +1,141 @@
+import heapq
+import math
+
+# NDJSON timestamps are whole seconds while binary ones are fractional, so
+# on a drone with both kinds of sensor the NDJSON readings trail the
+# watermark by up to a second before any network skew. Anything less than
+# that marks most of them late; the second second covers skew between
+# sensors. Summaries wait for both this and ALLOWED_LATENESS: a bucket is
+# sent about 7 s after it ends with the defaults.
+REORDER_DELAY = 2.0
+ALLOWED_LATENESS = 5.0
+REORDER_LIMIT = 64
+IDLE_TIMEOUT = 5.0
+# Event times further than this ahead of the wall clock are rejected: a
+# single one would move the drone's watermark into the future and every
+# real reading after it would be dropped as late.
+MAX_CLOCK_SKEW = 60.0
+
+
+class DroneClock:
+    # Event-time progress of one drone. The watermark only moves forward;
+    # readings at or before it have been released in timestamp order, so a
+    # reading older than the watermark can no longer be slotted in place.
+    __slots__ = ('max_ts', 'watermark', 'pending', 'last_arrival')
+
+    def __init__(self):
+        self.max_ts = -math.inf
+        self.watermark = -math.inf
+        self.pending = []
+        self.last_arrival = 0.0
+
+
+class EventTimeGate:
+    # Sits in front of a shard's windows and summaries. Each drone's readings
+    # wait in a small heap until the drone's watermark (newest event time
+    # seen minus reorder_delay) passes them, and are then released in event
+    # time order. A reading that arrives behind the watermark is late: up to
+    # allowed_lateness it is still released (flagged, so it can be counted
+    # into its summary bucket without disturbing the window), beyond that it
+    # is dropped. A heap longer than reorder_limit releases its oldest
+    # reading early, and a drone that goes quiet for idle_timeout seconds
+    # (wall clock) has its heap flushed by expire_idle(). A reading stamped
+    # more than max_skew seconds ahead of the wall clock is counted as a bad
+    # timestamp and dropped without touching the drone's clock.
+
+    def __init__(self, reorder_delay=REORDER_DELAY, allowed_lateness=ALLOWED_LATENESS,
+                 reorder_limit=REORDER_LIMIT, idle_timeout=IDLE_TIMEOUT, max_skew=MAX_CLOCK_SKEW):
+        self.reorder_delay = reorder_delay
+        self.allowed_lateness = allowed_lateness
+        self.reorder_limit = reorder_limit
+        self.idle_timeout = idle_timeout
+        self.max_skew = max_skew
+        self.clocks = {}
+        self.seq = 0
+        self.reordered = 0
+        self.late_accepted = 0
+        self.late_dropped = 0
+        self.forced = 0
+        self.bad_timestamps = 0
+        self.late_by_drone = {}
+
+    def offer(self, drone_id, ts, r, now):
+        if ts > now + self.max_skew:
+            self.bad_timestamps += 1
+            return []
+        clock = self.clocks.get(drone_id)
+        if clock is None:
+            clock = self.clocks[drone_id] = DroneClock()
+        clock.last_arrival = now
+
+        if ts < clock.watermark:
+            self.late_by_drone[drone_id] = self.late_by_drone.get(drone_id, 0) + 1
+            if ts >= clock.watermark - self.allowed_lateness:
+                self.late_accepted += 1
+                return [(r, ts, drone_id, True)]
+            self.late_dropped += 1
+            return []
+
+        if ts < clock.max_ts:
+            self.reordered += 1
+        else:
+            clock.max_ts = ts
+        watermark = max(clock.watermark, clock.max_ts - self.reorder_delay)
+        if not clock.pending and ts <= watermark:
+            clock.watermark = watermark
+            return [(r, ts, drone_id, False)]
+
+        self.seq += 1
+        heapq.heappush(clock.pending, (ts, self.seq, r))
+        return self._release(drone_id, clock, watermark)
+
+    def _release(self, drone_id, clock, watermark):
+        pending = clock.pending
+        released = []
+        while len(pending) > self.reorder_limit:
+            ts, _, r = heapq.heappop(pending)
+            watermark = max(watermark, ts)
+            self.forced += 1
+            released.append((r, ts, drone_id, False))
+        while pending and pending[0][0] <= watermark:
+            ts, _, r = heapq.heappop(pending)
+            released.append((r, ts, drone_id, False))
+        clock.watermark = watermark
+        return released
+
+    def expire_idle(self, now):
+        released = []
+        for drone_id, clock in self.clocks.items():
+            if clock.pending and now - clock.last_arrival >= self.idle_timeout:
+                released.extend(self._release(drone_id, clock, clock.max_ts))
+        return released
+
+    def release_drone(self, drone_id):
+        clock = self.clocks.get(drone_id)
+        if clock is None or not clock.pending:
+            return []
+        return self._release(drone_id, clock, clock.max_ts)
+
+    def forget(self, drone_id):
+        self.clocks.pop(drone_id, None)
+        self.late_by_drone.pop(drone_id, None)
+
+    def watermark(self, drone_id):
+        clock = self.clocks.get(drone_id)
+        return clock.watermark if clock is not None else -math.inf
+
+    def idle(self, drone_id, now):
+        clock = self.clocks.get(drone_id)
+        return clock is None or (not clock.pending and now - clock.last_arrival >= self.idle_timeout)
+
+    def stats(self):
+        return {
+            'drones': len(self.clocks),
+            'buffered': sum(len(c.pending) for c in list(self.clocks.values())),
+            'reordered': self.reordered,
+            'late_accepted': self.late_accepted,
+            'late_dropped': self.late_dropped,
+            'forced': self.forced,
+            'bad_timestamps': self.bad_timestamps,
+            'late_by_drone': dict(self.late_by_drone),
+        }
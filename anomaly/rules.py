@@ -0,0 +1,386 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import copy
+import json
+import math
+import random
+import time
+
+from anomaly.detectors import DetectorConfig
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(__file__), 'rules.json')
+OPS = ('<', '<=', '>', '>=', '==', '!=')
+# Fields the batch path (anomaly/vectorized.py) keeps as columns; rules on
+# any other field are still exact, they just fall back to the scalar check.
+BATCH_COLUMNS = ('temperature', 'pressure', 'altitude', 'motor_energies')
+
+
+class RuleError(ValueError):
+    pass
+
+
+class WindowRule:
+    __slots__ = ('span', 'min_readings', 'limits')
+
+    def __init__(self, span, min_readings, limits):
+        self.span = span
+        self.min_readings = min_readings
+        self.limits = limits
+
+
+class FlushRule:
+    __slots__ = ('interval', 'jitter')
+
+    def __init__(self, interval, jitter):
+        self.interval = interval
+        self.jitter = jitter
+
+
+class RuleProfile:
+    # The compiled rules that apply to one drone (the defaults, or the
+    # defaults merged with that drone's overrides).
+    #   check(r)        -> list of threshold/compound anomalies for a reading
+    #   hits(cols, n)   -> boolean array, True where check() may report
+    #                      something (needs numpy; used by batch mode)
+    __slots__ = ('check', 'hits', 'window', 'flush', 'source')
+
+    def __init__(self, check, hits, window, flush, source):
+        self.check = check
+        self.hits = hits
+        self.window = window
+        self.flush = flush
+        self.source = source
+
+
+def _number(value, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise RuleError(f"{where}: expected a finite number, got {value!r}")
+    return value
+
+
+def _validate_ranges(ranges, where):
+    if not isinstance(ranges, dict):
+        raise RuleError(f"{where}: 'ranges' must be an object")
+    for field, rng in ranges.items():
+        if not isinstance(rng, dict):
+            raise RuleError(f"{where}.{field}: range must be an object")
+        for key in rng:
+            if key not in ('min', 'max', 'each', 'label'):
+                raise RuleError(f"{where}.{field}: unknown key {key!r}")
+        for key in ('min', 'max'):
+            if rng.get(key) is not None:
+                _number(rng[key], f"{where}.{field}.{key}")
+
+
+def _validate_compound(rules, where):
+    if not isinstance(rules, list):
+        raise RuleError(f"{where}: 'compound' must be a list")
+    for i, rule in enumerate(rules):
+        here = f"{where}[{i}]"
+        if not isinstance(rule, dict) or not isinstance(rule.get('type'), str):
+            raise RuleError(f"{here}: compound rule needs a string 'type'")
+        modes = [m for m in ('all', 'any') if m in rule]
+        if len(modes) != 1 or not isinstance(rule[modes[0]], list) or not rule[modes[0]]:
+            raise RuleError(f"{here}: give exactly one non-empty 'all' or 'any' list")
+        for cond in rule[modes[0]]:
+            if not isinstance(cond, dict) or not isinstance(cond.get('field'), str):
+                raise RuleError(f"{here}: condition needs a string 'field'")
+            if cond.get('op') not in OPS:
+                raise RuleError(f"{here}: op must be one of {OPS}")
+            _number(cond.get('value'), f"{here}.{cond['field']}")
+
+
+def _validate_window(window, where):
+    if not isinstance(window, dict):
+        raise RuleError(f"{where}: 'window' must be an object")
+    if 'span' in window and _number(window['span'], f"{where}.span") <= 0:
+        raise RuleError(f"{where}.span must be positive")
+    if 'min_readings' in window and not isinstance(window['min_readings'], int):
+        raise RuleError(f"{where}.min_readings must be an integer")
+    spread = window.get('spread', {})
+    if not isinstance(spread, dict):
+        raise RuleError(f"{where}.spread must be an object")
+    for field, limit in spread.items():
+        _number(limit, f"{where}.spread.{field}")
+
+
+def _validate_flush(flush, where):
+    if not isinstance(flush, dict):
+        raise RuleError(f"{where}: 'flush' must be an object")
+    for key in flush:
+        if key not in ('interval', 'jitter'):
+            raise RuleError(f"{where}: unknown key {key!r}")
+    if 'interval' in flush and _number(flush['interval'], f"{where}.interval") <= 0:
+        raise RuleError(f"{where}.interval must be positive")
+    if 'jitter' in flush and not 0 <= _number(flush['jitter'], f"{where}.jitter") <= 0.5:
+        raise RuleError(f"{where}.jitter must be between 0 and 0.5 (a fraction of the interval)")
+
+
+def _validate_detectors(detectors, where):
+    if not isinstance(detectors, dict):
+        raise RuleError(f"{where}: 'detectors' must be an object")
+    for key in detectors:
+        if key not in ('enabled', 'fields', 'alpha', 'warmup', 'z_limit', 'cusum_k', 'cusum_h', 'rate'):
+            raise RuleError(f"{where}: unknown key {key!r}")
+    fields = detectors.get('fields', [])
+    if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+        raise RuleError(f"{where}.fields must be a list of field names")
+    if 'alpha' in detectors and not 0 < _number(detectors['alpha'], f"{where}.alpha") <= 1:
+        raise RuleError(f"{where}.alpha must be in (0, 1]")
+    if 'warmup' in detectors and not isinstance(detectors['warmup'], int):
+        raise RuleError(f"{where}.warmup must be an integer")
+    for key in ('z_limit', 'cusum_k', 'cusum_h'):
+        if key in detectors:
+            _number(detectors[key], f"{where}.{key}")
+    rate = detectors.get('rate', {})
+    if not isinstance(rate, dict):
+        raise RuleError(f"{where}.rate must be an object")
+    for field, limit in rate.items():
+        _number(limit, f"{where}.rate.{field}")
+
+
+def _merge(base, override):
+    merged = copy.deepcopy(base)
+    for field, rng in override.get('ranges', {}).items():
+        merged['ranges'].setdefault(field, {}).update(rng)
+    window = override.get('window', {})
+    for key in ('span', 'min_readings'):
+        if key in window:
+            merged['window'][key] = window[key]
+    merged['window']['spread'].update(window.get('spread', {}))
+    merged['compound'] = merged['compound'] + override.get('compound', [])
+    merged['flush'].update(override.get('flush', {}))
+    return merged
+
+
+def _range_condition(var, rng):
+    parts = []
+    if rng.get('min') is not None:
+        parts.append(f"{var} < {rng['min']!r}")
+    if rng.get('max') is not None:
+        parts.append(f"{var} > {rng['max']!r}")
+    return ' or '.join(parts)
+
+
+def _scalar_source(profile):
+    # Generated straight-line Python with every limit inlined as a literal,
+    # so evaluating a reading costs the same as the old hand-written checks.
+    lines = ['def check(r):', '    anomalies = []']
+    for field, rng in profile['ranges'].items():
+        cond = _range_condition('v', rng)
+        if not cond:
+            continue
+        if rng.get('each'):
+            label = rng.get('label', field)
+            lines += [
+                f"    vs = r.get({field!r})",
+                "    if vs:",
+                "        for idx, v in enumerate(vs):",
+                f"            if {cond}:",
+                f"                anomalies.append({{'type': {label + '_'!r} + str(idx), 'value': v}})",
+            ]
+        else:
+            lines += [
+                f"    v = r.get({field!r})",
+                f"    if v is not None and ({cond}):",
+                f"        anomalies.append({{'type': {field!r}, 'value': v}})",
+            ]
+
+    for rule in profile['compound']:
+        mode = 'all' if 'all' in rule else 'any'
+        fields = list(dict.fromkeys(c['field'] for c in rule[mode]))
+        names = {f: f'c{i}' for i, f in enumerate(fields)}
+        for f in fields:
+            lines.append(f"    {names[f]} = r.get({f!r})")
+        joiner = ' and ' if mode == 'all' else ' or '
+        conds = joiner.join(
+            f"({names[c['field']]} is not None and {names[c['field']]} {c['op']} {c['value']!r})"
+            for c in rule[mode]
+        )
+        values = ', '.join(f"{f!r}: {names[f]}" for f in fields)
+        lines += [
+            f"    if {conds}:",
+            f"        anomalies.append({{'type': {rule['type']!r}, 'values': {{{values}}}}})",
+        ]
+    lines.append('    return anomalies')
+    return '\n'.join(lines) + '\n'
+
+
+def _vector_source(profile, columns):
+    # The batch-mode counterpart: one boolean mask over a whole batch. A rule
+    # on a field that has no column makes every reading a candidate, so the
+    # scalar check still decides.
+    lines = ['def hits(cols, n):', '    h = np.zeros(n, dtype=bool)']
+    for field, rng in profile['ranges'].items():
+        cond = _range_condition('c', rng)
+        if not cond:
+            continue
+        if field not in columns:
+            return 'def hits(cols, n):\n    return np.ones(n, dtype=bool)\n'
+        cond = ' | '.join(f'({p})' for p in cond.split(' or '))
+        lines.append(f"    c = cols[{field!r}]")
+        if rng.get('each'):
+            lines.append(f"    h |= ({cond}).any(axis=0)")
+        else:
+            lines.append(f"    h |= {cond}")
+
+    for rule in profile['compound']:
+        mode = 'all' if 'all' in rule else 'any'
+        if any(c['field'] not in columns for c in rule[mode]):
+            return 'def hits(cols, n):\n    return np.ones(n, dtype=bool)\n'
+        parts = []
+        for c in rule[mode]:
+            expr = f"(cols[{c['field']!r}] {c['op']} {c['value']!r})"
+            if c['op'] == '!=':
+                expr = f"({expr} & ~np.isnan(cols[{c['field']!r}]))"
+            parts.append(expr)
+        lines.append(f"    h |= {(' & ' if mode == 'all' else ' | ').join(parts)}")
+    lines.append('    return h')
+    return '\n'.join(lines) + '\n'
+
+
+def _compile(source, name):
+    namespace = {'np': np}
+    exec(compile(source, f'<rules:{name}>', 'exec'), namespace)
+    return namespace
+
+
+class RuleEngine:
+    # Built once at startup from a rule file; afterwards the hot path only
+    # does a dict lookup for the drone's profile and calls compiled code.
+
+    def __init__(self, spec, columns=BATCH_COLUMNS):
+        spec = copy.deepcopy(spec)
+        spec.setdefault('ranges', {})
+        spec.setdefault('window', {})
+        spec['window'].setdefault('spread', {})
+        spec.setdefault('compound', [])
+        spec.setdefault('drones', {})
+        spec.setdefault('flush', {})
+        spec.setdefault('detectors', {'enabled': False})
+        _validate_ranges(spec['ranges'], 'ranges')
+        _validate_window(spec['window'], 'window')
+        _validate_compound(spec['compound'], 'compound')
+        _validate_detectors(spec['detectors'], 'detectors')
+        _validate_flush(spec['flush'], 'flush')
+        for drone_id, override in spec['drones'].items():
+            _validate_ranges(override.get('ranges', {}), f'drones.{drone_id}.ranges')
+            _validate_window(override.get('window', {}), f'drones.{drone_id}.window')
+            _validate_compound(override.get('compound', []), f'drones.{drone_id}.compound')
+            _validate_flush(override.get('flush', {}), f'drones.{drone_id}.flush')
+
+        self.spec = spec
+        self.columns = tuple(columns)
+        base = {k: spec[k] for k in ('ranges', 'window', 'compound', 'flush')}
+        self.default = self._profile(base, 'default')
+        self.overrides = {
+            drone_id: self._profile(_merge(base, override), drone_id)
+            for drone_id, override in spec['drones'].items()
+        }
+        detectors = dict(spec['detectors'])
+        self.detectors = DetectorConfig(**detectors) if detectors.pop('enabled', True) else None
+
+    def _profile(self, profile, name):
+        source = _scalar_source(profile)
+        check = _compile(source, name)['check']
+        hits = None
+        if np is not None:
+            hits = _compile(_vector_source(profile, self.columns), name)['hits']
+        w = profile['window']
+        window = WindowRule(float(w.get('span', 2.0)), w.get('min_readings', 4), dict(w['spread']))
+        f = profile['flush']
+        flush = FlushRule(float(f.get('interval', 2.0)), float(f.get('jitter', 0.1)))
+        return RuleProfile(check, hits, window, flush, source)
+
+    def profile(self, drone_id):
+        return self.overrides.get(drone_id, self.default)
+
+    def window_fields(self):
+        fields = dict.fromkeys(self.default.window.limits)
+        for p in self.overrides.values():
+            fields.update(dict.fromkeys(p.window.limits))
+        return tuple(fields)
+
+
+def load_rules(path=DEFAULT_RULES_PATH, columns=BATCH_COLUMNS):
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise RuntimeError("YAML rule files need PyYAML, which is not installed")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if not isinstance(spec, dict):
+        raise RuleError(f"{path}: rule file must contain an object")
+    return RuleEngine(spec, columns)
+
+
+def bench(engine, n=100000, drone_id=None):
+    # Synthetic readings in and slightly beyond the sensor ranges, so every
+    # rule both passes and fires some of the time.
+    rnd = random.Random(0)
+    readings = [
+        {
+            'temperature': rnd.uniform(-15, 65),
+            'pressure': rnd.uniform(250, 1150),
+            'altitude': rnd.uniform(-10, 520),
+            'humidity': rnd.uniform(10, 90),
+            'motor_energies': [rnd.randint(-2, 102) for _ in range(4)],
+        }
+        for _ in range(10000)
+    ]
+    profile = engine.profile(drone_id)
+    check = profile.check
+    rounds = max(1, n // len(readings))
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for r in readings:
+            check(r)
+    scalar = (time.perf_counter() - start) / (rounds * len(readings))
+    print(f"scalar check: {scalar * 1e9:8.0f} ns/reading")
+
+    if profile.hits is None:
+        print("vector kernel: skipped (numpy not installed)")
+        return
+    cols = {
+        field: np.array([r.get(field, math.nan) for r in readings], dtype=float)
+        for field in engine.columns if field != 'motor_energies'
+    }
+    if 'motor_energies' in engine.columns:
+        cols['motor_energies'] = np.array([r['motor_energies'] for r in readings], dtype=float).T
+    start = time.perf_counter()
+    for _ in range(rounds):
+        mask = profile.hits(cols, len(readings))
+    vector = (time.perf_counter() - start) / (rounds * len(readings))
+    print(f"vector kernel: {vector * 1e9:8.0f} ns/reading ({mask.mean() * 100:.1f}% candidates)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile an anomaly rule file and benchmark it.")
+    parser.add_argument('path', nargs='?', default=DEFAULT_RULES_PATH, help='Rule file (JSON or YAML)')
+    parser.add_argument('--drone-id', default=None, help='Benchmark the profile of this drone')
+    parser.add_argument('--readings', type=int, default=100000, help='Readings to evaluate')
+    parser.add_argument('--show-source', action='store_true', help='Print the generated checker')
+    args = parser.parse_args()
+
+    engine = load_rules(args.path)
+    if args.show_source:
+        print(engine.profile(args.drone_id).source)
+    bench(engine, args.readings, args.drone_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import math
+import random
+import zlib
+
+TICK = 0.1
+SLOTS = 512
+
+
+class TimerWheel:
+    # Hashed timer wheel: deadlines are hashed into SLOTS buckets of TICK
+    # seconds each, so scheduling is O(1) and advancing only looks at the
+    # slots whose time has come. Deadlines further out than one turn of the
+    # wheel simply stay in their slot until a later turn reaches them. Each
+    # key has at most one live timer; rescheduling or cancelling leaves the
+    # old entry behind, and it is skipped when its slot comes up.
+
+    def __init__(self, tick=TICK, slots=SLOTS, now=0.0):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.deadlines = {}
+        self.current = math.floor(now / tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        tick = max(math.floor(deadline / self.tick), self.current)
+        self.slots[tick % len(self.slots)].append((deadline, key))
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def advance(self, now):
+        # Returns the keys whose deadline is <= now, earliest first.
+        due = []
+        target = math.floor(now / self.tick)
+        n = len(self.slots)
+        # Past one full turn every slot is visited once.
+        for tick in range(self.current, min(target, self.current + n - 1) + 1):
+            slot = self.slots[tick % n]
+            if not slot:
+                continue
+            keep = []
+            for deadline, key in slot:
+                if self.deadlines.get(key) != deadline:
+                    continue
+                if deadline <= now:
+                    del self.deadlines[key]
+                    due.append((deadline, key))
+                else:
+                    keep.append((deadline, key))
+            self.slots[tick % n] = keep
+        self.current = target
+        due.sort(key=lambda item: item[0])
+        return [key for _, key in due]
+
+
+class FlushScheduler:
+    # When to check each drone for complete summary buckets. A drone is on
+    # the wheel only while it has pending summaries, so idle drones cost
+    # nothing. Every drone gets a fixed phase within its interval (from a
+    # hash of its id) plus random jitter, so checks, and with them the
+    # sends to central, are spread over the interval instead of all drones
+    # firing on the same tick.
+
+    def __init__(self, interval_of, jitter_of, now=0.0):
+        self.interval_of = interval_of
+        self.jitter_of = jitter_of
+        self.wheel = TimerWheel(now=now)
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def phase(self, drone_id, interval):
+        return (zlib.crc32(drone_id.encode('utf-8')) / 0xFFFFFFFF) * interval
+
+    def arm(self, drone_id, now):
+        if drone_id in self.wheel:
+            return
+        interval = self.interval_of(drone_id)
+        # Next point after now on the drone's own phase grid.
+        phase = self.phase(drone_id, interval)
+        deadline = math.floor((now - phase) / interval + 1) * interval + phase
+        self._schedule(drone_id, deadline, interval)
+
+    def _schedule(self, drone_id, deadline, interval):
+        jitter = self.jitter_of(drone_id) * interval
+        if jitter:
+            deadline += random.uniform(-jitter, jitter)
+        self.wheel.schedule(drone_id, deadline)
+
+    def due(self, now):
+        return self.wheel.advance(now)
+
+    def cancel(self, drone_id):
+        self.wheel.cancel(drone_id)
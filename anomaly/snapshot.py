@@ -0,0 +1,418 @@
+import gc
+import glob
+import heapq
+import json
+import mmap
+import os
+import signal
+import struct
+import threading
+import time
+from array import array
+from contextlib import ExitStack
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from anomaly.window import MonotonicWindow
+from anomaly.aggregates import SummaryAccumulator, FieldStats, SUMMARY_FIELDS
+from anomaly.event_time import DroneClock
+from anomaly.detectors import STRIDE
+from comm.readings import shard_of
+from logger import setup_logger
+
+SNAPSHOT_INTERVAL = 10.0
+# A child still writing after this many seconds is killed.
+SNAPSHOT_TIMEOUT = 60.0
+MAGIC = b'DRSNAP01'
+# magic, index length in bytes, data length in doubles
+HEADER = struct.Struct('<8sQQ')
+
+snapshot_logger = setup_logger('snapshot', 'logs/server/snapshot.log')
+
+# Snapshot file layout: HEADER, a JSON index with one entry per drone, then
+# (8-byte aligned) one flat block of doubles that the index entries point
+# into: window contents, summary buckets and detector state. Restoring maps
+# the file and reads each drone's slices straight out of the mapping.
+
+
+def _encode_window(window, data):
+    start = len(data)
+    if isinstance(window, MonotonicWindow):
+        data.extend((window.head, window.next_index, len(window.times)))
+        data.extend(window.times)
+        for field in window.fields:
+            for entries in (window.mins[field], window.maxs[field]):
+                data.append(len(entries))
+                for i, v in entries:
+                    data.append(i)
+                    data.append(v)
+        return ['mono', start, len(data) - start, list(window.fields)]
+    # A ColumnarRing (anomaly/vectorized.py): its rows in window order.
+    columns = window.columns()
+    data.frombytes(columns.tobytes())
+    return ['ring', start, columns.shape[0], columns.shape[1]]
+
+def _encode_buckets(buckets, data):
+    start = len(data)
+    for bucket, acc in buckets.items():
+        data.extend((bucket, acc.count))
+        data.extend(acc.sums)
+        data.extend(acc.counts)
+        if acc.motor_sums is None:
+            data.append(-1)
+        else:
+            data.append(len(acc.motor_sums))
+            data.extend(acc.motor_sums)
+        if acc.stats is None:
+            data.append(0)
+        else:
+            data.append(1)
+            for st in acc.stats:
+                data.extend((st.n, st.mean, st.m2, st.min, st.max))
+    return [start, len(data) - start, len(buckets)]
+
+def encode(shards):
+    # Reads shard state without taking any locks: this runs in a forked
+    # child, where a lock held by another thread at fork time stays held.
+    data = array('d')
+    drones = []
+    detector_fields = None
+    for shard in shards:
+        detectors = shard.detectors
+        if detectors is not None:
+            detector_fields = list(detectors.config.fields)
+        # In event-time gate order (the order idle drones are released in);
+        # 'seen' is the drone's place in the LRU order.
+        recency = {drone_id: rank for rank, drone_id in enumerate(shard.states.last_seen)}
+        for drone_id in dict.fromkeys([*shard.gate.clocks, *recency]):
+            entry = {'id': drone_id, 'battery': shard.batteries.peek_state(drone_id)}
+            if drone_id in recency:
+                entry['seen'] = recency[drone_id]
+
+            sensors = shard.states.sensors.get(drone_id)
+            if sensors is not None:
+                refs = []
+                for sensor_id in sensors:
+                    state = detectors.states.get(sensor_id) if detectors is not None else None
+                    if state is None:
+                        refs.append([sensor_id, None, 0])
+                    else:
+                        refs.append([sensor_id, len(data), len(state)])
+                        data.extend(state)
+                entry['sensors'] = refs
+
+            clock = shard.gate.clocks.get(drone_id)
+            if clock is not None:
+                entry['clock'] = [clock.max_ts, clock.watermark, [[ts, r] for ts, _, r in clock.pending]]
+
+            window = shard.buffers.get(drone_id)
+            if window is not None and len(window):
+                entry['window'] = _encode_window(window, data)
+
+            buckets = shard.summary_buffers.get(drone_id)
+            if buckets:
+                entry['buckets'] = _encode_buckets(buckets, data)
+            drones.append(entry)
+    index = {'created': time.time(), 'detector_fields': detector_fields, 'drones': drones}
+    return index, data
+
+def write_snapshot(path, shards):
+    index, data = encode(shards)
+    blob = json.dumps(index, separators=(',', ':')).encode('utf-8')
+    data_start = HEADER.size + len(blob)
+    data_start += -data_start % 8
+    size = data_start + len(data) * data.itemsize
+    tmp = path + '.tmp'
+    with open(tmp, 'w+b') as f:
+        f.truncate(size)
+        with mmap.mmap(f.fileno(), size) as mm:
+            mm[:HEADER.size] = HEADER.pack(MAGIC, len(blob), len(data))
+            mm[HEADER.size:HEADER.size + len(blob)] = blob
+            mm[data_start:size] = data
+            mm.flush()
+    os.replace(tmp, path)
+    return size
+
+
+def _decode_window(shard, drone_id, ref, values):
+    # Windows are only restored into the kind of shard that wrote them; a
+    # window of the other kind (batch mode switched) refills within a span.
+    kind = ref[0]
+    if kind == 'mono' and not hasattr(shard, '_ring'):
+        window = shard.buffers[drone_id]
+        if list(window.fields) != ref[3]:
+            return
+        v = values[ref[1]:ref[1] + ref[2]].tolist()
+        window.head = int(v[0])
+        window.next_index = int(v[1])
+        p = 3 + int(v[2])
+        window.times.extend(v[3:p])
+        for field in window.fields:
+            for entries in (window.mins[field], window.maxs[field]):
+                end = p + 1 + 2 * int(v[p])
+                entries.extend(zip(map(int, v[p + 1:end:2]), v[p + 2:end:2]))
+                p = end
+    elif kind == 'ring' and hasattr(shard, '_ring'):
+        ring = shard._ring(drone_id)
+        rows, size = ref[2], ref[3]
+        if rows != ring.data.shape[0]:
+            return
+        block = np.frombuffer(values[ref[1]:ref[1] + rows * size], dtype=float).reshape(rows, size)
+        ring.extend(block)
+
+def _decode_buckets(ref, values):
+    v = values[ref[0]:ref[0] + ref[1]].tolist()
+    fields = len(SUMMARY_FIELDS)
+    buckets = {}
+    p = 0
+    for _ in range(ref[2]):
+        acc = buckets[v[p]] = SummaryAccumulator()
+        acc.count = int(v[p + 1])
+        p += 2
+        acc.sums = v[p:p + fields]
+        acc.counts = [int(x) for x in v[p + fields:p + 2 * fields]]
+        p += 2 * fields
+        motors = int(v[p])
+        p += 1
+        if motors >= 0:
+            acc.motor_sums = v[p:p + motors]
+            p += motors
+        has_stats = v[p]
+        p += 1
+        if has_stats:
+            acc.stats = []
+            for _ in range(fields):
+                st = FieldStats()
+                st.n = int(v[p])
+                st.mean, st.m2, st.min, st.max = v[p + 1:p + 5]
+                acc.stats.append(st)
+                p += 5
+    return buckets
+
+def _restore_drone(shard, entry, values, index, now):
+    drone_id = entry['id']
+    if entry.get('battery') is not None:
+        shard.batteries.import_state(drone_id, entry['battery'])
+
+    sensors = entry.get('sensors')
+    if sensors is not None:
+        detectors = shard.statistical_detectors()
+        usable = detectors is not None and index['detector_fields'] == list(detectors.config.fields)
+        for sensor_id, offset, length in sensors:
+            shard.states.touch(drone_id, sensor_id, now)
+            if usable and offset is not None and length == STRIDE * len(detectors.config.fields):
+                detectors.states[sensor_id] = array('d', values[offset:offset + length].tobytes())
+
+    if 'clock' in entry:
+        max_ts, watermark, pending = entry['clock']
+        if max_ts > now + shard.gate.max_skew:
+            # Written before future timestamps were rejected: the clock, and
+            # the window and buckets it ordered, would block the drone.
+            return
+        clock = shard.gate.clocks[drone_id] = DroneClock()
+        clock.max_ts = max_ts
+        clock.watermark = watermark
+        clock.last_arrival = now
+        for ts, r in pending:
+            shard.gate.seq += 1
+            heapq.heappush(clock.pending, (ts, shard.gate.seq, r))
+
+    if 'window' in entry:
+        _decode_window(shard, drone_id, entry['window'], values)
+
+    if 'buckets' in entry:
+        with shard.summary_lock:
+            shard.summary_buffers[drone_id] = _decode_buckets(entry['buckets'], values)
+            shard.flushes.arm(drone_id, now)
+
+def _open(path):
+    f = open(path, 'rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    magic, index_len, count = HEADER.unpack_from(mm)
+    if magic != MAGIC:
+        mm.close()
+        raise ValueError(f"{path} is not a snapshot file")
+    index = json.loads(mm[HEADER.size:HEADER.size + index_len])
+    data_start = HEADER.size + index_len
+    data_start += -data_start % 8
+    return mm, index, data_start, count
+
+def restore(paths, shard_for, now=None):
+    # Loads the drones in the snapshot files into the shards chosen by
+    # shard_for(drone_id) (None = not ours). A drone found in several files
+    # comes from the newest one. Returns the number of drones restored.
+    now = time.time() if now is None else now
+    snapshots = []
+    for path in paths:
+        try:
+            snapshots.append(_open(path))
+        except (OSError, ValueError) as e:
+            snapshot_logger.warning(f"Skipping snapshot {path}: {e}")
+    snapshots.sort(key=lambda s: s[1]['created'], reverse=True)
+
+    # Restoring allocates many small objects and nothing cyclic; collection
+    # passes over the growing heap would only slow it down.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _restore_all(snapshots, shard_for, now)
+    finally:
+        if enabled:
+            gc.enable()
+
+def _restore_all(snapshots, shard_for, now):
+    seen = set()
+    recency = []
+    restored = 0
+    for mm, index, data_start, count in snapshots:
+        with memoryview(mm) as raw, raw[data_start:data_start + count * 8].cast('d') as values:
+            for entry in index['drones']:
+                drone_id = entry['id']
+                if drone_id in seen:
+                    continue
+                seen.add(drone_id)
+                shard = shard_for(drone_id)
+                if shard is not None:
+                    _restore_drone(shard, entry, values, index, now)
+                    restored += 1
+                    if 'seen' in entry:
+                        recency.append((entry['seen'], drone_id, shard))
+        mm.close()
+    # Entries are in event-time gate order; put the LRU order back as well.
+    recency.sort(key=lambda item: item[0])
+    for _, drone_id, shard in recency:
+        shard.states.last_seen.move_to_end(drone_id)
+    return restored
+
+
+class Snapshotter:
+    # Writes the state of a set of shards to one snapshot file every
+    # interval seconds. The writing happens in a forked child, which sees a
+    # copy-on-write image of the process as of the fork. Other threads are
+    # frozen wherever they were at that instant, so the fork happens with
+    # every shard quiesced: its thread between items (work_lock), and the
+    # aggregator out of its summaries (summary_lock) and battery bank
+    # (lock). The consumer threads wait for the fork and nothing else;
+    # they carry on while the child writes. The file is written next to
+    # the old one and swapped in with os.replace, so a crash mid-write
+    # leaves the previous snapshot intact, as does a child killed for
+    # taking longer than timeout seconds.
+
+    def __init__(self, path, shards, interval=SNAPSHOT_INTERVAL, timeout=SNAPSHOT_TIMEOUT):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("Snapshots need os.fork, which this platform does not provide")
+        self.path = path
+        self.shards = shards
+        self.interval = interval
+        self.timeout = timeout
+        self.written = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name='snapshot', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def _quiesce(self, stack):
+        # Always in this order; shard threads and the aggregator never take
+        # work_lock while holding either of the others.
+        for shard in self.shards:
+            stack.enter_context(shard.work_lock)
+            stack.enter_context(shard.summary_lock)
+            stack.enter_context(shard.batteries.lock)
+
+    def save(self):
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            self._quiesce(stack)
+            pid = os.fork()
+            if pid == 0:
+                # Only this thread exists in the child, and the locks other
+                # threads held (logging's included) stay held: no logging,
+                # no traceback, and os._exit so nothing else runs on the way
+                # out.
+                code = 1
+                try:
+                    write_snapshot(self.path, self.shards)
+                    code = 0
+                finally:
+                    os._exit(code)
+        forked = time.perf_counter() - start
+        status = self._wait(pid, start + self.timeout)
+        elapsed = time.perf_counter() - start
+        if status is None:
+            self.failed += 1
+            snapshot_logger.error(f"Snapshot to {self.path} killed after {self.timeout:.0f} s")
+        elif os.waitstatus_to_exitcode(status) == 0:
+            self.written += 1
+            snapshot_logger.info(f"Snapshot written to {self.path} in {elapsed * 1e3:.0f} ms "
+                                 f"(fork {forked * 1e3:.1f} ms, {os.path.getsize(self.path)} bytes)")
+        else:
+            self.failed += 1
+            snapshot_logger.error(f"Snapshot to {self.path} failed (status {status})")
+
+    def _wait(self, pid, deadline):
+        # The child's exit status, or None after killing it at the deadline.
+        # The previous snapshot stays in place; only the partial file goes.
+        delay = 0.001
+        while time.perf_counter() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                return status
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        try:
+            os.remove(self.path + '.tmp')
+        except FileNotFoundError:
+            pass
+        return None
+
+snapshot_dir = None
+snapshot_name = 'main'
+interval = SNAPSHOT_INTERVAL
+# This process's ingest worker and the number of them; drones belong to
+# worker shard_of(drone_id, owners), as routed by comm/server.py.
+owner = 0
+owners = 1
+
+def configure(directory=None, name='main', every=SNAPSHOT_INTERVAL, worker=0, workers=1):
+    global snapshot_dir, snapshot_name, interval, owner, owners
+    snapshot_dir = directory
+    snapshot_name = name
+    interval = every
+    owner = worker
+    owners = workers
+
+def snapshot_files():
+    # Every snapshot in the directory, whichever worker or shard wrote it:
+    # with a different --workers or consumer count a drone's state can sit
+    # in another process's file. restore() keeps the newest copy of each.
+    return glob.glob(os.path.join(snapshot_dir, '*.snap'))
+
+def start(shards, shard_for, suffix=''):
+    # Restores what the previous run left behind, then keeps snapshotting
+    # the shards. Does nothing unless a snapshot directory is configured.
+    # shard_for only has to pick among this process's shards; drones owned
+    # by another ingest worker are skipped here.
+    if snapshot_dir is None:
+        return None
+    os.makedirs(snapshot_dir, exist_ok=True)
+    files = snapshot_files()
+    if files:
+        began = time.perf_counter()
+        def owned(drone_id):
+            return shard_for(drone_id) if shard_of(drone_id, owners) == owner else None
+        restored = restore(files, owned)
+        snapshot_logger.info(f"Restored {restored} drones from {len(files)} snapshot file(s) "
+                             f"in {(time.perf_counter() - began) * 1e3:.1f} ms")
+    return Snapshotter(os.path.join(snapshot_dir, f'{snapshot_name}{suffix}.snap'), shards, interval)
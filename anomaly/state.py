@@ -0,0 +1,96 @@
+import json
+import os
+from collections import OrderedDict
+from urllib.parse import quote
+
+DRONE_TTL = 300.0
+MAX_DRONES = 0
+MAX_OPEN_LOGS = 256
+
+
+class DroneStates:
+    # Recency tracking for the drones a shard holds state for, oldest first.
+    # touch() is O(1) per reading; expired() and overflow() only look at the
+    # oldest entries, so sweeping costs nothing while every drone is live.
+    # The shard does the actual eviction of whatever they return.
+
+    def __init__(self, ttl=DRONE_TTL, max_drones=MAX_DRONES):
+        self.ttl = ttl
+        self.max_drones = max_drones
+        self.last_seen = OrderedDict()
+        self.sensors = {}
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self.restored = 0
+        self.checkpointed = 0
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def touch(self, drone_id, sensor_id, now):
+        # True the first time a drone is seen (or seen again after eviction).
+        new = drone_id not in self.last_seen
+        self.last_seen[drone_id] = now
+        self.last_seen.move_to_end(drone_id)
+        sensors = self.sensors.get(drone_id)
+        if sensors is None:
+            self.sensors[drone_id] = {sensor_id}
+        elif sensor_id not in sensors:
+            sensors.add(sensor_id)
+        return new
+
+    def expired(self, now):
+        if not self.ttl:
+            return []
+        cutoff = now - self.ttl
+        idle = []
+        for drone_id, seen in self.last_seen.items():
+            if seen >= cutoff:
+                break
+            idle.append(drone_id)
+        return idle
+
+    def overflow(self):
+        extra = len(self.last_seen) - self.max_drones if self.max_drones else 0
+        if extra <= 0:
+            return []
+        return [drone_id for drone_id, _ in zip(self.last_seen, range(extra))]
+
+    def remove(self, drone_id):
+        self.last_seen.pop(drone_id, None)
+        return self.sensors.pop(drone_id, ())
+
+    def stats(self):
+        return {
+            'drones': len(self.last_seen),
+            'evicted_idle': self.evicted_idle,
+            'evicted_lru': self.evicted_lru,
+            'restored': self.restored,
+            'checkpointed': self.checkpointed,
+        }
+
+
+class BatteryCheckpoints:
+    # Battery state of evicted drones, one small JSON file per drone so that
+    # shard processes (which never share a drone) never share a file.
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, drone_id):
+        return os.path.join(self.path, quote(drone_id, safe='') + '.json')
+
+    def save(self, drone_id, state):
+        target = self._file(drone_id)
+        tmp = target + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, target)
+
+    def load(self, drone_id):
+        try:
+            with open(self._file(drone_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,281 @@
+import json
+import math
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import anomaly.consumer as consumer
+from anomaly.consumer import ConsumerShard
+from anomaly.aggregates import SummaryAccumulator
+
+COLUMNS = ('ts', 'temperature', 'pressure', 'altitude', 'motor_0', 'motor_1', 'motor_2', 'motor_3')
+COLUMN_INDEX = {name: i for i, name in enumerate(COLUMNS)}
+MOTORS = 4
+
+
+class ColumnarRing:
+    # One drone's discrepancy window as a ring of NumPy columns (one row per
+    # column in COLUMNS, so every column is contiguous). Capacity doubles
+    # when a burst does not fit; missing fields are stored as NaN.
+
+    __slots__ = ('data', 'start', 'size')
+
+    def __init__(self, capacity=64):
+        self.data = np.empty((len(COLUMNS), capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _indices(self):
+        cap = self.data.shape[1]
+        return (self.start + np.arange(self.size)) % cap
+
+    def column(self, name):
+        return self.data[COLUMN_INDEX[name]].take(self._indices())
+
+    def columns(self):
+        return self.data.take(self._indices(), axis=1)
+
+    def extend(self, block):
+        k = block.shape[1]
+        cap = self.data.shape[1]
+        if self.size + k > cap:
+            while self.size + k > cap:
+                cap *= 2
+            data = np.empty((len(COLUMNS), cap))
+            data[:, :self.size] = self.columns()
+            self.data = data
+            self.start = 0
+        pos = (self.start + self.size + np.arange(k)) % cap
+        self.data[:, pos] = block
+        self.size += k
+
+    def drop(self, k):
+        self.start = (self.start + k) % self.data.shape[1]
+        self.size -= k
+
+
+class VectorizedShard(ConsumerShard):
+    # Evaluates a drained batch of readings with array operations: the range
+    # thresholds over the whole batch at once, and every drone's window
+    # min/max with one reduceat per field over the drones' concatenated
+    # windows. The window a reading is judged against is exactly the one the
+    # per-reading path would use (prefix expiry in the order the event-time
+    # gate releases readings), so it finds exactly the same anomalies; they
+    # are logged per drone and batch rather than per reading.
+
+    def __init__(self, index=0, reorder_delay=consumer.REORDER_DELAY, allowed_lateness=consumer.ALLOWED_LATENESS):
+        if np is None:
+            raise RuntimeError("Vectorized batch mode needs numpy, which is not installed")
+        super().__init__(index, reorder_delay, allowed_lateness)
+        for field in consumer.rule_engine.window_fields():
+            if field not in COLUMN_INDEX:
+                raise ValueError(f"Discrepancy field {field!r} has no column in the batch ring buffer")
+        self.buffers = {}
+
+    def _ring(self, drone_id):
+        ring = self.buffers.get(drone_id)
+        if ring is None:
+            ring = self.buffers[drone_id] = ColumnarRing()
+        return ring
+
+    def process_released(self, released):
+        # Battery drain, summary accounting and logging all happen once per
+        # drone (or once per batch) here rather than once per reading as in
+        # admit() and report(); at batch sizes in the hundreds those, not
+        # detection, are what the per-reading path spends its time on.
+        admitted = []
+        rows = []
+        irregular = []
+        dropped = {}
+        for (r, ts, drone_id, late), (accepted, level) in zip(released, self.drain(released)):
+            if not accepted:
+                count, _ = dropped.get(drone_id, (0, level))
+                dropped[drone_id] = (count + 1, level)
+                continue
+            if level < consumer.CRITICAL_LEVEL:
+                r['motor_energies'] = [0] * len(r.get('motor_energies', []))
+            m = r.get('motor_energies')
+            if m is not None and len(m) == MOTORS:
+                rows.append((ts, r.get('temperature'), r.get('pressure'), r.get('altitude'), m[0], m[1], m[2], m[3]))
+            else:
+                irregular.append(len(admitted))
+                rows.append((ts, r.get('temperature'), r.get('pressure'), r.get('altitude'), None, None, None, None))
+            admitted.append((r, drone_id, late))
+        for drone_id, (count, level) in dropped.items():
+            consumer.get_drone_logger(drone_id).warning(
+                f"Battery critical ({level:.1f}%), dropping {count} reading{'s' if count > 1 else ''}")
+        if not admitted:
+            return
+
+        # None (missing field) becomes NaN, which fails every comparison.
+        block = np.ascontiguousarray(np.array(rows, dtype=float).T)
+        times = block[0].tolist()
+        interval = consumer.BATCH_INTERVAL
+        self._account(admitted, (np.floor(block[0] / interval) * interval).tolist())
+
+        engine = consumer.rule_engine
+        threshold_hits = self._threshold_hits(engine, admitted, block)
+        for j in irregular:
+            threshold_hits[j] = True
+        discrepancies = self._discrepancies(engine, admitted, block)
+
+        reports = {}
+        for j, (r, drone_id, _) in enumerate(admitted):
+            anoms = engine.profile(drone_id).check(r) if threshold_hits[j] else []
+            extra = discrepancies.get(j)
+            if extra:
+                anoms.extend(extra)
+            # The statistical detectors carry state from one reading to the
+            # next, so they stay sequential.
+            anoms.extend(self.detect_statistical_anomalies(r, times[j]))
+            entries = reports.get(drone_id)
+            if entries is None:
+                reports[drone_id] = [(r, anoms)]
+            else:
+                entries.append((r, anoms))
+        self.report_batch(reports)
+
+    def _account(self, admitted, buckets):
+        # admit()'s summary accounting for a whole batch under one lock.
+        now = time.time()
+        with self.summary_lock:
+            for (r, drone_id, _), bucket in zip(admitted, buckets):
+                drone_buckets = self.summary_buffers.get(drone_id)
+                if drone_buckets is None:
+                    drone_buckets = self.summary_buffers[drone_id] = {}
+                    self.flushes.arm(drone_id, now)
+                acc = drone_buckets.get(bucket)
+                if acc is None:
+                    acc = drone_buckets[bucket] = SummaryAccumulator(consumer.SUMMARY_STATS)
+                acc.add(r)
+
+    def report_batch(self, reports):
+        # reports: drone_id -> [(reading, anomalies)] in release order. Each
+        # drone gets one line for its clean readings and one for its
+        # anomalous ones, and the anomaly log one line per drone.
+        for drone_id, entries in reports.items():
+            logger = consumer.get_drone_logger(drone_id)
+            flagged = [{'sensor_id': r.get('sensor_id', ''), 'timestamp': r.get('timestamp'), 'anomalies': anoms}
+                       for r, anoms in entries if anoms]
+            if flagged:
+                text = json.dumps(flagged)
+                logger.warning(f"Anomalies detected in {len(flagged)} readings: {text}")
+                consumer.anomaly_logger.warning(f"{drone_id} → {text}")
+            clean = len(entries) - len(flagged)
+            if clean:
+                sensors = sorted({r.get('sensor_id', '') for r, anoms in entries if not anoms})
+                logger.info(f"Accepted {clean} readings from {', '.join(sensors)} "
+                            f"({entries[0][0].get('timestamp')} to {entries[-1][0].get('timestamp')})")
+
+    def _threshold_hits(self, engine, admitted, block):
+        # The rule file's compiled kernel flags candidates over the whole
+        # batch; only those go through the scalar check, which builds the
+        # anomaly dicts in the original order and value types.
+        motor = COLUMN_INDEX['motor_0']
+        if not engine.overrides:
+            cols = self._rule_columns(block, motor)
+            return engine.default.hits(cols, block.shape[1]).tolist()
+
+        groups = {}
+        for j, (_, drone_id, _) in enumerate(admitted):
+            profile = engine.profile(drone_id)
+            group = groups.get(id(profile))
+            if group is None:
+                groups[id(profile)] = (profile, [j])
+            else:
+                group[1].append(j)
+        hits = np.zeros(block.shape[1], dtype=bool)
+        for profile, positions in groups.values():
+            sub = block[:, positions]
+            hits[positions] = profile.hits(self._rule_columns(sub, motor), len(positions))
+        return hits.tolist()
+
+    @staticmethod
+    def _rule_columns(block, motor):
+        cols = {name: block[i] for name, i in COLUMN_INDEX.items() if i < motor}
+        cols['motor_energies'] = block[motor:]
+        return cols
+
+    def _discrepancies(self, engine, admitted, block):
+        by_drone = {}
+        for j, (_, drone_id, late) in enumerate(admitted):
+            if late:
+                # Behind the watermark: judged on thresholds only, like the
+                # per-reading path.
+                continue
+            positions = by_drone.get(drone_id)
+            if positions is None:
+                by_drone[drone_id] = [j]
+            else:
+                positions.append(j)
+
+        # Lay every drone's window out as [current window | new readings] in
+        # one array, then find each reading's window [head, own position]
+        # by replaying prefix expiry with scalar timestamps.
+        parts = []
+        starts = []
+        ends = []
+        order = []
+        windows = []
+        offset = 0
+        for drone_id, positions in by_drone.items():
+            rule = engine.profile(drone_id).window
+            span = rule.span
+            ring = self._ring(drone_id)
+            history = ring.columns()
+            new = block[:, positions]
+            base = history.shape[1]
+            times = history[0].tolist() + new[0].tolist()
+            head = 0
+            for k in range(base, len(times)):
+                cutoff = times[k] - span
+                while times[head] < cutoff:
+                    head += 1
+                starts.append(offset + head)
+            ends.extend(range(offset + base + 1, offset + len(times) + 1))
+            order.extend(positions)
+            windows.extend([rule] * len(positions))
+            parts.append(history)
+            parts.append(new)
+            ring.extend(new)
+            ring.drop(head)
+            offset += len(times)
+
+        starts = np.array(starts, dtype=np.intp)
+        ends = np.array(ends, dtype=np.intp)
+        min_readings = np.array([w.min_readings for w in windows], dtype=np.intp)
+        eligible = (ends - starts) >= min_readings
+        if not eligible.any():
+            return {}
+
+        combined = np.concatenate(parts, axis=1)
+        # reduceat over interleaved (start, end) pairs reduces [start, end) at
+        # the even positions; a trailing pad keeps every end index in bounds.
+        bounds = np.empty(2 * len(starts), dtype=np.intp)
+        bounds[0::2] = starts
+        bounds[1::2] = ends
+        spreads = {}
+        flagged = np.zeros(len(starts), dtype=bool)
+        for field in engine.window_fields():
+            col = np.append(combined[COLUMN_INDEX[field]], math.nan)
+            spread = np.fmax.reduceat(col, bounds)[0::2] - np.fmin.reduceat(col, bounds)[0::2]
+            # Drones whose rules have no limit for this field never flag it.
+            limits = np.array([w.limits.get(field, math.inf) for w in windows])
+            flagged |= spread > limits
+            spreads[field] = spread
+
+        result = {}
+        for i in np.flatnonzero(flagged & eligible).tolist():
+            anoms = []
+            for field, limit in windows[i].limits.items():
+                value = float(spreads[field][i])
+                if value > limit:
+                    anoms.append({'type': f'{field}_discrepancy', 'range': value})
+            result[order[i]] = anoms
+        return result
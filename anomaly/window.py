@@ -0,0 +1,61 @@
+from collections import deque
+
+
+class MonotonicWindow:
+    # Sliding time window over one drone's readings that answers min/max per
+    # field in amortised O(1). Readings are numbered in arrival order; expiry
+    # drops a prefix of that order (exactly like popping the front of a plain
+    # deque), and each field keeps a deque of (index, value) that is
+    # increasing for the minimum and decreasing for the maximum.
+
+    __slots__ = ('span', 'fields', 'times', 'head', 'next_index', 'mins', 'maxs')
+
+    def __init__(self, span, fields):
+        self.span = span
+        self.fields = tuple(fields)
+        self.times = deque()
+        self.head = 0
+        self.next_index = 0
+        self.mins = {f: deque() for f in self.fields}
+        self.maxs = {f: deque() for f in self.fields}
+
+    def __len__(self):
+        return len(self.times)
+
+    def push(self, ts, reading):
+        i = self.next_index
+        self.next_index += 1
+        self.times.append(ts)
+        for f in self.fields:
+            if f not in reading:
+                continue
+            v = reading[f]
+            lo = self.mins[f]
+            while lo and lo[-1][1] >= v:
+                lo.pop()
+            lo.append((i, v))
+            hi = self.maxs[f]
+            while hi and hi[-1][1] <= v:
+                hi.pop()
+            hi.append((i, v))
+
+    def expire(self, now):
+        cutoff = now - self.span
+        times = self.times
+        while times and times[0] < cutoff:
+            times.popleft()
+            self.head += 1
+        head = self.head
+        for f in self.fields:
+            lo = self.mins[f]
+            while lo and lo[0][0] < head:
+                lo.popleft()
+            hi = self.maxs[f]
+            while hi and hi[0][0] < head:
+                hi.popleft()
+
+    def range(self, field):
+        lo = self.mins[field]
+        if not lo:
+            return None
+        return self.maxs[field][0][1] - lo[0][1]
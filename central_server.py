@@ -1,37 +1,115 @@
-import socket
+import argparse
 import json
-from logger import setup_logger
+import socket
+import threading
+import time
+from comm import central_client
+from comm.codec import get_codec, CODEC_CHOICES
+from comm.event_loop import run_loops
+from comm.framing import LineFramer, RECV_SIZE, MAX_LINE_LENGTH
+from central_store import SummaryStore
+import logger as log_config
+from logger import setup_logger, console
 
 central_logger = setup_logger('central_server', 'logs/server/central_server.log')
 
-HOST, PORT = '0.0.0.0', 1000
-
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
-    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    srv.bind((HOST, PORT))
-    srv.listen()
-    central_logger.info(f"Central server listening on {HOST}:{PORT}")
-    print(f"Central server listening on {HOST}:{PORT}")
-
-    while True:
-        conn, addr = srv.accept()
-        central_logger.info(f"Connection from {addr}")
-        print(f"Connection from {addr}")
-        with conn:
-            buffer = ""
-            while True:
-                data = conn.recv(1024)
-                if not data:
-                    break
-                buffer += data.decode('utf-8', errors='replace')
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if line.strip():
-                        try:
-                            summary = json.loads(line)
-                            central_logger.info(f"Received summary: {json.dumps(summary)}")
-                            print("Received summary:", summary)
-                        except json.JSONDecodeError:
-                            central_logger.warning(f"Invalid JSON from {addr}: {line}")
-            central_logger.info(f"Connection closed from {addr}")
-            print(f"Connection closed from {addr}")
+HOST, PORT = '0.0.0.0', central_client.PORT
+STATS_INTERVAL = 10.0
+
+codec = get_codec('json')
+received = 0
+invalid = 0
+stats_lock = threading.Lock()
+# Columnar store the summaries are appended to (see central_store.py), if any.
+store = None
+
+
+def handle_summary(summary, addr):
+    central_logger.info(f"Received summary: {json.dumps(summary)}")
+    console("Received summary:", summary)
+    if store is not None:
+        try:
+            store.append(summary)
+        except (KeyError, TypeError, ValueError) as e:
+            central_logger.warning(f"Not storing malformed summary from {addr}: {e}")
+
+
+class CentralSession:
+    # One drone server's uplink connection: NDJSON summaries, one per line,
+    # usually many per packet since the uplink batches them.
+
+    def __init__(self, addr, recv_size=RECV_SIZE, max_line=MAX_LINE_LENGTH):
+        self.addr = addr
+        self.framer = LineFramer(recv_size, max_line)
+        console(f"Connection from {addr}")
+
+    def process(self, conn):
+        global received, invalid
+        good = bad = 0
+        for line in self.framer.lines():
+            try:
+                summary = codec.decode(line)
+            except ValueError:
+                bad += 1
+                central_logger.warning(f"Invalid JSON from {self.addr}: {line.decode('utf-8', errors='replace')}")
+                continue
+            good += 1
+            handle_summary(summary, self.addr)
+        with stats_lock:
+            received += good
+            invalid += bad
+
+
+def start_stats_reporter(interval=STATS_INTERVAL):
+    def report_loop():
+        last = 0
+        while True:
+            time.sleep(interval)
+            if store is not None:
+                store.flush()
+            if received != last:
+                central_logger.info(f"Received {received} summaries ({(received - last) / interval:.0f}/s), "
+                                    f"{invalid} invalid lines")
+                last = received
+
+    threading.Thread(target=report_loop, name='central-stats', daemon=True).start()
+
+def serve(host=HOST, port=PORT, loops=1, recv_size=RECV_SIZE, max_line=MAX_LINE_LENGTH, codec_name='json',
+          store_dir=None):
+    # Every drone server connection is multiplexed on selector loops, so a
+    # slow or stuck sender only ever holds up its own connection.
+    global codec, store
+    codec = get_codec(codec_name)
+    if store_dir:
+        store = SummaryStore(store_dir)
+        central_logger.info(f"Storing summaries in {store_dir}")
+    start_stats_reporter()
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+        central_logger.info(f"Central server listening on {host}:{port} ({loops} loop(s))")
+        console(f"Central server listening on {host}:{port}")
+        run_loops(sock, lambda addr: CentralSession(addr, recv_size, max_line), central_logger, loops=loops)
+
+def main():
+    parser = argparse.ArgumentParser(description="Central server receiving drone summaries.")
+    parser.add_argument('--host', default=HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+    parser.add_argument('--loops', type=int, default=1, help='Number of event loops sharing the listening socket')
+    parser.add_argument('--recv-size', type=int, default=RECV_SIZE, help='Socket receive buffer size in bytes')
+    parser.add_argument('--max-line', type=int, default=MAX_LINE_LENGTH,
+                        help='Longest accepted NDJSON line; longer lines drop the connection')
+    parser.add_argument('--codec', choices=CODEC_CHOICES, default='json',
+                        help='Decoder for incoming summaries (must read what the drone servers send)')
+    parser.add_argument('--store-dir', default=None,
+                        help='Also append summaries to a columnar time-series store in this directory '
+                             '(query it with central_store.py)')
+    log_config.add_arguments(parser)
+    args = parser.parse_args()
+    log_config.apply_arguments(args, hot_loggers=('central_server',))
+
+    serve(args.host, args.port, max(1, args.loops), args.recv_size, args.max_line, args.codec, args.store_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import argparse
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STORE_DIR = 'store/central'
+# Records per segment file and per sparse index entry.
+SEGMENT_RECORDS = 65536
+INDEX_STRIDE = 1024
+MOTORS = 4
+MAX_OPEN_SEGMENTS = 256
+PAGE = 4096
+
+MAGIC = b'DRSEG001'
+# magic, capacity, index stride, record count, min timestamp, max timestamp
+HEADER = struct.Struct('<8sQQQdd')
+INDEX_START = 64
+COLUMNS = ('timestamp', 'avg_temperature', 'avg_pressure', 'avg_altitude') + tuple(
+    f'motor_{i}' for i in range(MOTORS))
+DOUBLE = struct.Struct('<d')
+
+
+def parse_time(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        raise ValueError(f"Unsupported timestamp {value!r}")
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def _number(value):
+    return math.nan if value is None else float(value)
+
+
+class Segment:
+    # One fixed-size segment file of a drone's summaries, laid out by
+    # column: a header page (record count, time range and the sparse index,
+    # i.e. the min/max timestamp of every INDEX_STRIDE records), then one
+    # contiguous run of little-endian doubles per column in COLUMNS. The file
+    # is created at full size (sparse on disk) and written through a shared
+    # mapping; the count in the header goes last, so a reader never sees a
+    # half-written record.
+
+    def __init__(self, path, capacity=SEGMENT_RECORDS, stride=INDEX_STRIDE, writable=False):
+        self.path = path
+        exists = os.path.exists(path)
+        if writable and not exists:
+            blocks = -(-capacity // stride)
+            size = self.data_start_for(blocks) + len(COLUMNS) * capacity * 8
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        with open(path, 'r+b' if writable else 'rb') as f:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self.mm = mmap.mmap(f.fileno(), 0, access=access)
+        if writable and not exists:
+            HEADER.pack_into(self.mm, 0, MAGIC, capacity, stride, 0, math.inf, -math.inf)
+        magic, self.capacity, self.stride, _, _, _ = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"{path} is not a summary segment")
+        self.blocks = -(-self.capacity // self.stride)
+        self.data_start = self.data_start_for(self.blocks)
+
+    @staticmethod
+    def data_start_for(blocks):
+        end = INDEX_START + 16 * blocks
+        return -(-end // PAGE) * PAGE
+
+    def header(self):
+        # (count, min timestamp, max timestamp)
+        _, _, _, count, lo, hi = HEADER.unpack_from(self.mm)
+        return count, lo, hi
+
+    def column_offset(self, column):
+        return self.data_start + column * self.capacity * 8
+
+    def append(self, values):
+        # values: one double per column. Returns False once the segment is full.
+        count, lo, hi = self.header()
+        if count >= self.capacity:
+            return False
+        mm = self.mm
+        for column, v in enumerate(values):
+            DOUBLE.pack_into(mm, self.column_offset(column) + count * 8, v)
+        ts = values[0]
+        block = count // self.stride
+        lo_at = INDEX_START + block * 8
+        hi_at = INDEX_START + (self.blocks + block) * 8
+        if count % self.stride == 0:
+            DOUBLE.pack_into(mm, lo_at, ts)
+            DOUBLE.pack_into(mm, hi_at, ts)
+        else:
+            if ts < DOUBLE.unpack_from(mm, lo_at)[0]:
+                DOUBLE.pack_into(mm, lo_at, ts)
+            if ts > DOUBLE.unpack_from(mm, hi_at)[0]:
+                DOUBLE.pack_into(mm, hi_at, ts)
+        HEADER.pack_into(mm, 0, MAGIC, self.capacity, self.stride, count + 1, min(lo, ts), max(hi, ts))
+        return True
+
+    def scan(self, start, end):
+        # Rows with start <= timestamp <= end as an (n, len(COLUMNS)) array.
+        # Only index blocks whose time range overlaps are read.
+        count, lo, hi = self.header()
+        if not count or hi < start or lo > end:
+            return None
+        blocks = -(-count // self.stride)
+        index = np.frombuffer(self.mm, dtype='<f8', count=2 * self.blocks, offset=INDEX_START)
+        hit = np.flatnonzero((index[self.blocks:self.blocks + blocks] >= start) & (index[:blocks] <= end))
+        if not len(hit):
+            return None
+        first = hit[0] * self.stride
+        last = min(count, (hit[-1] + 1) * self.stride)
+        columns = np.frombuffer(self.mm, dtype='<f8', count=len(COLUMNS) * self.capacity,
+                                offset=self.data_start).reshape(len(COLUMNS), self.capacity)
+        rows = columns[:, first:last]
+        keep = (rows[0] >= start) & (rows[0] <= end)
+        return rows[:, keep].T.copy()
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+
+
+class SummaryStore:
+    # Append-only per-drone time series of the summaries central receives.
+    # Each drone has a directory of numbered segments; appends go to the
+    # newest one and start a new one when it is full. At most max_open
+    # segments (each holding a file descriptor and a mapping) are kept
+    # open for writing, least recently used closed first.
+
+    def __init__(self, path=STORE_DIR, capacity=SEGMENT_RECORDS, stride=INDEX_STRIDE, max_open=MAX_OPEN_SEGMENTS):
+        self.path = path
+        self.capacity = capacity
+        self.stride = stride
+        self.max_open = max_open
+        self.writers = OrderedDict()
+        self.lock = threading.Lock()
+        self.appended = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _drone_dir(self, drone_id):
+        # quote() escapes '/', but '', '.' and '..' would still name the
+        # store itself or its parent.
+        name = quote(drone_id, safe='')
+        if name in ('', '.', '..'):
+            raise ValueError(f"Invalid drone_id {drone_id!r}")
+        return os.path.join(self.path, name)
+
+    def segments(self, drone_id):
+        try:
+            names = os.listdir(self._drone_dir(drone_id))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.seg'))
+
+    def drones(self):
+        return sorted(unquote(name) for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def _segment_path(self, drone_id, number):
+        return os.path.join(self._drone_dir(drone_id), f'{number:08d}.seg')
+
+    def _writer(self, drone_id):
+        # Caller holds the lock.
+        writer = self.writers.get(drone_id)
+        if writer is not None:
+            self.writers.move_to_end(drone_id)
+            return writer
+        os.makedirs(self._drone_dir(drone_id), exist_ok=True)
+        numbers = self.segments(drone_id)
+        number = numbers[-1] if numbers else 0
+        segment = Segment(self._segment_path(drone_id, number), self.capacity, self.stride, writable=True)
+        writer = self.writers[drone_id] = [number, segment]
+        while self.max_open and len(self.writers) > self.max_open:
+            _, (_, oldest) = self.writers.popitem(last=False)
+            oldest.flush()
+            oldest.close()
+        return writer
+
+    def append(self, summary):
+        drone_id = summary['drone_id']
+        motors = summary.get('avg_motor_energies') or []
+        values = [parse_time(summary['timestamp']),
+                  _number(summary.get('avg_temperature')),
+                  _number(summary.get('avg_pressure')),
+                  _number(summary.get('avg_altitude'))]
+        values.extend(_number(motors[i]) if i < len(motors) else math.nan for i in range(MOTORS))
+        with self.lock:
+            writer = self._writer(drone_id)
+            if not writer[1].append(values):
+                writer[1].flush()
+                writer[1].close()
+                writer[0] += 1
+                writer[1] = Segment(self._segment_path(drone_id, writer[0]), self.capacity, self.stride,
+                                    writable=True)
+                writer[1].append(values)
+            self.appended += 1
+
+    def scan(self, drone_id, start=-math.inf, end=math.inf):
+        # A drone's summaries between two epoch times as columns: a dict of
+        # NumPy arrays keyed like the summary fields, with the motor columns
+        # as one (n, MOTORS) array under 'avg_motor_energies'.
+        if np is None:
+            raise RuntimeError("Scanning the summary store needs numpy, which is not installed")
+        parts = []
+        for number in self.segments(drone_id):
+            segment = Segment(self._segment_path(drone_id, number))
+            try:
+                rows = segment.scan(start, end)
+            finally:
+                segment.close()
+            if rows is not None:
+                parts.append(rows)
+        rows = np.concatenate(parts) if parts else np.empty((0, len(COLUMNS)))
+        return {
+            'timestamp': rows[:, 0],
+            'avg_temperature': rows[:, 1],
+            'avg_pressure': rows[:, 2],
+            'avg_altitude': rows[:, 3],
+            'avg_motor_energies': rows[:, 4:],
+        }
+
+    def flush(self):
+        with self.lock:
+            for _, segment in self.writers.values():
+                segment.flush()
+
+    def close(self):
+        with self.lock:
+            for _, segment in self.writers.values():
+                segment.flush()
+                segment.close()
+            self.writers.clear()
+
+
+def bench(path, drones=100, per_drone=20000):
+    # Appends synthetic summaries (one every 2 s per drone), then scans
+    # every drone in full and a one-hour range of each.
+    store = SummaryStore(path)
+    t0 = 1.7e9
+    start = time.perf_counter()
+    for i in range(per_drone):
+        ts = t0 + 2 * i
+        for d in range(drones):
+            store.append({'drone_id': f'drone_{d}', 'timestamp': ts, 'avg_temperature': 20.0 + d,
+                          'avg_pressure': 900.0, 'avg_altitude': 100.0, 'avg_motor_energies': [50.0] * MOTORS})
+    store.close()
+    elapsed = time.perf_counter() - start
+    n = drones * per_drone
+    print(f"append: {n} summaries in {elapsed:.2f}s ({n / elapsed:.0f}/s)")
+
+    start = time.perf_counter()
+    rows = sum(len(store.scan(f'drone_{d}')['timestamp']) for d in range(drones))
+    elapsed = time.perf_counter() - start
+    size = rows * len(COLUMNS) * 8
+    print(f"full scan: {rows} rows in {elapsed * 1e3:.0f} ms ({size / elapsed / 1e6:.0f} MB/s of columns)")
+
+    mid = t0 + per_drone
+    start = time.perf_counter()
+    rows = sum(len(store.scan(f'drone_{d}', mid, mid + 3600)['timestamp']) for d in range(drones))
+    elapsed = time.perf_counter() - start
+    print(f"1h range scan: {rows} rows in {elapsed * 1e3:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or benchmark the central summary store.")
+    parser.add_argument('--store', default=STORE_DIR, help='Store directory')
+    parser.add_argument('--drone-id', default=None, help='Drone to scan (default: list drones)')
+    parser.add_argument('--start', default=None, help='ISO time to scan from')
+    parser.add_argument('--end', default=None, help='ISO time to scan to')
+    parser.add_argument('--bench', action='store_true', help='Append and scan synthetic data in --store')
+    args = parser.parse_args()
+
+    if args.bench:
+        bench(args.store)
+        return
+    store = SummaryStore(args.store)
+    if args.drone_id is None:
+        for drone_id in store.drones():
+            print(drone_id, f"{len(store.segments(drone_id))} segment(s)")
+        return
+    start = parse_time(args.start) if args.start else -math.inf
+    end = parse_time(args.end) if args.end else math.inf
+    cols = store.scan(args.drone_id, start, end)
+    n = len(cols['timestamp'])
+    print(f"{n} summaries for {args.drone_id}")
+    if n:
+        first = datetime.utcfromtimestamp(cols['timestamp'].min()).strftime('%Y-%m-%dT%H:%M:%SZ')
+        last = datetime.utcfromtimestamp(cols['timestamp'].max()).strftime('%Y-%m-%dT%H:%M:%SZ')
+        print(f"from {first} to {last}")
+        for field in ('avg_temperature', 'avg_pressure', 'avg_altitude'):
+            print(f"{field}: mean {np.nanmean(cols[field]):.3f}, min {np.nanmin(cols[field]):.3f}, "
+                  f"max {np.nanmax(cols[field]):.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,175 @@
 import threading
-import time
-from collections import defaultdict
-
-battery_levels = defaultdict(lambda: 100.0)
-returned_to_base = set()
 
 DRAIN_PER_SEC   = 0.1
 DRAIN_PER_READ  = 0.05
 DRAIN_PER_SEND  = 0.2
 DRAIN_MOTOR_FAC = 0.001
 
+# Below this level readings are dropped, below RETURN_LEVEL summaries are
+# no longer sent and the drone is told to return to base (once).
+CRITICAL_LEVEL = 10
+RETURN_LEVEL = 20
+
+# Events raised by banks that drain on a tick (comm/fleet_battery.py).
+LOW_BATTERY = 'low_battery'
+RETURN_TO_BASE = 'return_to_base'
+
+
+class BatteryState:
+    __slots__ = ('level', 'last_timestamp', 'returned_to_base')
+
+    def __init__(self, level=100.0, last_timestamp=None, returned_to_base=False):
+        self.level = level
+        self.last_timestamp = last_timestamp
+        self.returned_to_base = returned_to_base
+
+
+class BatteryBank:
+    # Battery state for a set of drones, one BatteryState per drone. Each
+    # consumer shard owns a bank for the drones hashed to it, so the lock is
+    # only ever shared between that shard's thread and the aggregator, not
+    # across the fleet. drain_batch() charges a whole run of readings under
+    # one acquisition instead of two per reading.
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, drone_id):
+        return drone_id in self.states
+
+    def _state(self, drone_id):
+        # Caller holds the lock.
+        state = self.states.get(drone_id)
+        if state is None:
+            state = self.states[drone_id] = BatteryState()
+        return state
+
+    def tick(self, now):
+        # Drones only drain when they report here; see comm/fleet_battery.py
+        # for a bank that also drains silent drones.
+        return []
+
+    def drain_batch(self, drone_id, readings):
+        # readings: (event time, late) pairs in the order they are processed.
+        # Late readings are behind the drone's clock and do not advance it.
+        # Returns (accepted, level) per reading: a reading is accepted if the
+        # battery was not critical when it arrived, and level is the charge
+        # after reading it (or the critical level it was dropped at).
+        results = []
+        with self.lock:
+            state = self._state(drone_id)
+            level = state.level
+            last = state.last_timestamp
+            for ts, late in readings:
+                if not late:
+                    if last is not None:
+                        level = max(0.0, level - (ts - last) * DRAIN_PER_SEC)
+                    last = ts
+                if level < CRITICAL_LEVEL:
+                    results.append((False, level))
+                    continue
+                level = max(0.0, level - DRAIN_PER_READ)
+                results.append((True, level))
+            state.level = level
+            state.last_timestamp = last
+        return results
 
-last_timestamp = {}
+    def update_time_drain(self, drone_id, now_ts):
+        with self.lock:
+            state = self._state(drone_id)
+            if state.last_timestamp is not None:
+                state.level = max(0.0, state.level - (now_ts - state.last_timestamp) * DRAIN_PER_SEC)
+            state.last_timestamp = now_ts
 
-lock = threading.Lock()
+    def drain_on_read(self, drone_id):
+        with self.lock:
+            state = self._state(drone_id)
+            state.level = max(0.0, state.level - DRAIN_PER_READ)
+            return state.level
+
+    def drain_on_send(self, drone_id, avg_motor_power):
+        with self.lock:
+            state = self._state(drone_id)
+            drain = DRAIN_PER_SEND + (avg_motor_power * DRAIN_MOTOR_FAC)
+            state.level = max(0.0, state.level - drain)
+            return state.level
+
+    def get_level(self, drone_id):
+        state = self.states.get(drone_id)
+        return state.level if state is not None else 100.0
+
+    def check_return_to_base(self, drone_id):
+        with self.lock:
+            state = self._state(drone_id)
+            if state.level < RETURN_LEVEL and not state.returned_to_base:
+                state.returned_to_base = True
+                return True, state.level
+            return False, state.level
+
+    def should_enqueue(self, drone_id):
+        return self.get_level(drone_id) >= CRITICAL_LEVEL
+
+    def peek_state(self, drone_id):
+        # Like export_state but leaves the drone in place and takes no lock,
+        # so it is safe in a process forked while the lock was held.
+        state = self.states.get(drone_id)
+        if state is None:
+            return None
+        return {
+            'level': state.level,
+            'last_timestamp': state.last_timestamp,
+            'returned_to_base': state.returned_to_base,
+        }
+
+    def export_state(self, drone_id):
+        # Removes the drone and returns what is needed to restore it later,
+        # or None if nothing is known about it.
+        with self.lock:
+            state = self.states.pop(drone_id, None)
+        if state is None:
+            return None
+        return {
+            'level': state.level,
+            'last_timestamp': state.last_timestamp,
+            'returned_to_base': state.returned_to_base,
+        }
+
+    def import_state(self, drone_id, state):
+        with self.lock:
+            self.states[drone_id] = BatteryState(state['level'], state.get('last_timestamp'),
+                                                 bool(state.get('returned_to_base')))
+
+
+# Drones not owned by a consumer shard.
+default_bank = BatteryBank()
 
 def update_time_drain(drone_id, now_ts):
-    with lock:
-        last = last_timestamp.get(drone_id, now_ts)
-        delta = now_ts - last
-        battery_levels[drone_id] = max(0.0,
-            battery_levels[drone_id] - delta * DRAIN_PER_SEC
-        )
-        last_timestamp[drone_id] = now_ts
+    default_bank.update_time_drain(drone_id, now_ts)
 
 def drain_on_read(drone_id):
-    with lock:
-        battery_levels[drone_id] = max(0.0,
-            battery_levels[drone_id] - DRAIN_PER_READ
-        )
-        return battery_levels[drone_id]
+    return default_bank.drain_on_read(drone_id)
 
 def drain_on_send(drone_id, avg_motor_power):
-    with lock:
-        drain = DRAIN_PER_SEND + (avg_motor_power * DRAIN_MOTOR_FAC)
-        battery_levels[drone_id] = max(0.0, battery_levels[drone_id] - drain)
-        return battery_levels[drone_id]
+    return default_bank.drain_on_send(drone_id, avg_motor_power)
+
+def drain_batch(drone_id, readings):
+    return default_bank.drain_batch(drone_id, readings)
 
 def get_level(drone_id):
-    return battery_levels[drone_id]
+    return default_bank.get_level(drone_id)
 
 def check_return_to_base(drone_id):
-    lvl = battery_levels[drone_id]
-    if lvl < 20 and drone_id not in returned_to_base:
-        returned_to_base.add(drone_id)
-        return True, lvl
-    return False, lvl
+    return default_bank.check_return_to_base(drone_id)
 
 def should_enqueue(drone_id):
-    return battery_levels[drone_id] >= 10
+    return default_bank.should_enqueue(drone_id)
+
+def export_state(drone_id):
+    return default_bank.export_state(drone_id)
+
+def import_state(drone_id, state):
+    default_bank.import_state(drone_id, state)
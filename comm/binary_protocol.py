@@ -0,0 +1,174 @@
+import struct
+import time
+from comm.framing import FrameError
+
+# A binary connection opens with MAGIC, then carries typed frames:
+#   HELLO    client -> server  type, u8 length, sensor_id (utf-8)
+#   WELCOME  server -> client  type, u32 sensor id (numbered per connection)
+#   READING  client -> server  type, u32 sid, f64 epoch timestamp,
+#            f64 temperature, humidity, pressure, altitude, 4 x u8 motors
+#   BATCH    client -> server  type, u32 sid, u16 count, then count reading
+#            bodies (the READING layout without type and sid)
+# NDJSON connections never start with a NUL byte, which is how the server
+# tells the two apart.
+MAGIC = b'\x00DR1'
+
+HELLO = 0x10
+WELCOME = 0x11
+READING = 0x01
+BATCH = 0x02
+
+HEADER = struct.Struct('<B')
+HELLO_HEADER = struct.Struct('<BB')
+WELCOME_FRAME = struct.Struct('<BI')
+READING_FRAME = struct.Struct('<BIdddddBBBB')
+BATCH_HEADER = struct.Struct('<BIH')
+READING_BODY = struct.Struct('<dddddBBBB')
+MAX_BATCH = 0xFFFF
+
+
+class ProtocolError(FrameError):
+    pass
+
+
+def encode_hello(sensor_id):
+    name = sensor_id.encode('utf-8')
+    if len(name) > 255:
+        raise ValueError("sensor_id longer than 255 bytes")
+    return HELLO_HEADER.pack(HELLO, len(name)) + name
+
+
+def decode_welcome(data):
+    kind, sid = WELCOME_FRAME.unpack(data)
+    if kind != WELCOME:
+        raise ProtocolError(f"expected WELCOME frame, got type {kind:#x}")
+    return sid
+
+
+def encode_reading(sid, reading, ts=None):
+    m = reading['motor_energies']
+    return READING_FRAME.pack(
+        READING, sid,
+        time.time() if ts is None else ts,
+        reading['temperature'], reading['humidity'],
+        reading['pressure'], reading['altitude'],
+        m[0], m[1], m[2], m[3],
+    )
+
+
+def encode_batch(sid, readings, timestamps=None):
+    if len(readings) > MAX_BATCH:
+        raise ValueError(f"batch of {len(readings)} readings exceeds {MAX_BATCH}")
+    now = time.time()
+    parts = [BATCH_HEADER.pack(BATCH, sid, len(readings))]
+    for i, reading in enumerate(readings):
+        m = reading['motor_energies']
+        parts.append(READING_BODY.pack(
+            now if timestamps is None else timestamps[i],
+            reading['temperature'], reading['humidity'],
+            reading['pressure'], reading['altitude'],
+            m[0], m[1], m[2], m[3],
+        ))
+    return b''.join(parts)
+
+
+class BinaryDecoder:
+    # Turns a connection's framer buffer into reading dicts (READING frames)
+    # and lists of reading dicts (BATCH frames). The dicts carry the epoch
+    # timestamp under 'epoch' so the consumer never has to parse the ISO
+    # string, which is only kept for log lines and summaries. Sensor ids are
+    # numbered per connection, so nothing outlives the session.
+
+    def __init__(self, framer):
+        self.framer = framer
+        self.greeted = False
+        self.sids = {}
+        self.sensors = {}
+        self._second = None
+        self._iso = ''
+
+    def _iso_timestamp(self, ts):
+        second = int(ts)
+        if second != self._second:
+            self._second = second
+            self._iso = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(second))
+        return self._iso
+
+    def _reading(self, sensor_id, ts, temp, hum, pres, alt, m0, m1, m2, m3):
+        return {
+            'sensor_id': sensor_id,
+            'temperature': temp,
+            'humidity': hum,
+            'pressure': pres,
+            'altitude': alt,
+            'motor_energies': [m0, m1, m2, m3],
+            'timestamp': self._iso_timestamp(ts),
+            'epoch': ts,
+        }
+
+    def _sensor(self, sid):
+        sensor_id = self.sensors.get(sid)
+        if sensor_id is None:
+            raise ProtocolError(f"reading for unknown sensor id {sid}")
+        return sensor_id
+
+    def decode(self, reply):
+        buf = self.framer.buffer
+        pos = 0
+        end = len(buf)
+        items = []
+
+        if not self.greeted:
+            if end < len(MAGIC):
+                return items
+            if buf[:len(MAGIC)] != MAGIC:
+                raise ProtocolError("bad binary protocol magic")
+            self.greeted = True
+            pos = len(MAGIC)
+
+        frame_size = READING_FRAME.size
+        unpack = READING_FRAME.unpack_from
+        try:
+            while pos < end:
+                kind = buf[pos]
+                if kind == READING:
+                    if end - pos < frame_size:
+                        break
+                    fields = unpack(buf, pos)
+                    pos += frame_size
+                    items.append(self._reading(self._sensor(fields[1]), *fields[2:]))
+                elif kind == BATCH:
+                    if end - pos < BATCH_HEADER.size:
+                        break
+                    _, sid, count = BATCH_HEADER.unpack_from(buf, pos)
+                    start = pos + BATCH_HEADER.size
+                    stop = start + count * READING_BODY.size
+                    if end < stop:
+                        break
+                    sensor_id = self._sensor(sid)
+                    pos = stop
+                    reading = self._reading
+                    items.append([
+                        reading(sensor_id, *fields)
+                        for fields in READING_BODY.iter_unpack(buf[start:stop])
+                    ])
+                elif kind == HELLO:
+                    if end - pos < HELLO_HEADER.size:
+                        break
+                    length = buf[pos + 1]
+                    start = pos + HELLO_HEADER.size
+                    if end - start < length:
+                        break
+                    sensor_id = buf[start:start + length].decode('utf-8', errors='replace')
+                    pos = start + length
+                    sid = self.sids.get(sensor_id)
+                    if sid is None:
+                        sid = self.sids[sensor_id] = len(self.sids)
+                        self.sensors[sid] = sensor_id
+                    reply(WELCOME_FRAME.pack(WELCOME, sid))
+                else:
+                    raise ProtocolError(f"unknown frame type {kind:#x}")
+        finally:
+            if pos:
+                self.framer.consume(pos)
+        return items
@@ -1,9 +1,130 @@
+import queue
 import socket
-import json
+import threading
+from comm.codec import get_codec
 
 HOST, PORT = '127.0.0.1', 4000
+POOL_SIZE = 2
+CONNECT_TIMEOUT = 5.0
+
+codec = get_codec('json')
+
+def set_codec(name):
+    global codec
+    codec = get_codec(name)
+
+
+class UplinkClient:
+    # Long-lived NDJSON connections to the central server. Up to pool_size
+    # sockets are opened on demand and reused; a batch of summaries is
+    # encoded into one buffer and written with a single sendall. Central
+    # never writes back, so a socket with anything to read has been closed
+    # or reset by the other side and is replaced before it is written to
+    # (otherwise the first write after a central restart would vanish into
+    # a dead connection). A write that fails is retried once on a fresh
+    # connection before the error is raised.
+
+    def __init__(self, host=HOST, port=PORT, pool_size=POOL_SIZE, timeout=CONNECT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.connects = 0
+        self.batches = 0
+        self.sent = 0
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connects += 1
+        return sock
+
+    @staticmethod
+    def _stale(sock):
+        # A non-blocking peek rather than select(), which cannot take
+        # descriptors past FD_SETSIZE (1024) and a drone server holding
+        # thousands of sensor sockets easily has those.
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+        finally:
+            sock.settimeout(timeout)
+        return True
+
+    def _acquire(self):
+        self.slots.acquire()
+        while True:
+            try:
+                sock = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if not self._stale(sock):
+                return sock
+            sock.close()
+        try:
+            return self._connect()
+        except OSError:
+            self.slots.release()
+            raise
+
+    def _release(self, sock):
+        if sock is not None:
+            self.idle.put(sock)
+        self.slots.release()
+
+    def send_many(self, payloads):
+        if not payloads:
+            return
+        self.send_data(b''.join(codec.encode(p) + b'\n' for p in payloads))
+        self.sent += len(payloads)
+
+    def send_data(self, data):
+        # data is one or more complete NDJSON lines.
+        sock = self._acquire()
+        try:
+            try:
+                sock.sendall(data)
+            except OSError:
+                sock.close()
+                sock = None
+                sock = self._connect()
+                sock.sendall(data)
+        except OSError:
+            if sock is not None:
+                sock.close()
+                sock = None
+            raise
+        finally:
+            self._release(sock)
+        self.batches += 1
+
+    def send(self, payload):
+        self.send_many([payload])
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+uplink = UplinkClient()
+
+def configure(host=HOST, port=PORT, pool_size=POOL_SIZE):
+    global uplink
+    uplink.close()
+    uplink = UplinkClient(host, port, pool_size)
 
 def send_to_central(payload: dict):
-    data = json.dumps(payload) + '\n'
-    with socket.create_connection((HOST, PORT)) as sock:
-        sock.sendall(data.encode('utf-8'))
+    uplink.send(payload)
+
+def send_batch(payloads):
+    uplink.send_many(payloads)
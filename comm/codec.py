@@ -0,0 +1,172 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import re
+import time
+import timeit
+from calendar import timegm
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from comm.readings import drop_epoch
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    name = 'json'
+    sets_epoch = False
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+
+class OrjsonCodec:
+    name = 'orjson'
+    sets_epoch = False
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson codec selected but orjson is not installed")
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+
+_NUM = rb'(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)'
+_INT = rb'(-?\d+)'
+READING_LINE = re.compile(
+    rb'\{"sensor_id": "([^"\\]*)", '
+    rb'"temperature": ' + _NUM + rb', '
+    rb'"humidity": ' + _NUM + rb', '
+    rb'"pressure": ' + _NUM + rb', '
+    rb'"altitude": ' + _NUM + rb', '
+    rb'"motor_energies": \[' + _INT + rb', ' + _INT + rb', ' + _INT + rb', ' + _INT + rb'\], '
+    rb'"timestamp": "(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ)"\}\s*\Z'
+)
+READING_KEYS = {'sensor_id', 'temperature', 'humidity', 'pressure', 'altitude', 'motor_energies', 'timestamp'}
+READING_TEMPLATE = ('{"sensor_id": %s, "temperature": %r, "humidity": %r, "pressure": %r, '
+                    '"altitude": %r, "motor_energies": [%d, %d, %d, %d], "timestamp": %s}')
+
+
+class SchemaCodec:
+    # Specialised for the reading layout comm/sensor.py emits. Lines that
+    # match it are decoded with one regex match and no generic JSON
+    # scanning; the epoch for the ISO timestamp is cached per second and
+    # returned under 'epoch' so the consumer can skip parse_timestamp.
+    # Anything else (batches, summaries, hand-written JSON) falls back to
+    # the stdlib decoder, so the codec is safe to use for every line.
+    # Decoding measures about as fast as the stdlib's C scanner (see
+    # bench()), so 'auto' does not pick it.
+    name = 'schema'
+    sets_epoch = True
+
+    def __init__(self):
+        self._ts = None
+        self._epoch = 0.0
+
+    def _epoch_of(self, ts):
+        if ts != self._ts:
+            self._epoch = float(timegm(time.strptime(ts, '%Y-%m-%dT%H:%M:%SZ')))
+            self._ts = ts
+        return self._epoch
+
+    def decode(self, data):
+        m = READING_LINE.match(data)
+        if m is None:
+            # Only the epochs computed below are trusted.
+            item = json.loads(data)
+            drop_epoch(item)
+            return item
+        sensor_id, t, h, p, a, m0, m1, m2, m3, ts = m.groups()
+        ts = ts.decode('ascii')
+        return {
+            'sensor_id': sensor_id.decode('utf-8'),
+            'temperature': float(t),
+            'humidity': float(h),
+            'pressure': float(p),
+            'altitude': float(a),
+            'motor_energies': [int(m0), int(m1), int(m2), int(m3)],
+            'timestamp': ts,
+            'epoch': self._epoch_of(ts),
+        }
+
+    def encode(self, obj):
+        if type(obj) is dict and obj.keys() == READING_KEYS:
+            m = obj['motor_energies']
+            if len(m) == 4:
+                return (READING_TEMPLATE % (
+                    encode_basestring_ascii(obj['sensor_id']),
+                    obj['temperature'], obj['humidity'], obj['pressure'], obj['altitude'],
+                    m[0], m[1], m[2], m[3],
+                    encode_basestring_ascii(obj['timestamp']),
+                )).encode('ascii')
+        return json.dumps(obj).encode('utf-8')
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'schema': SchemaCodec,
+}
+CODEC_CHOICES = ('auto',) + tuple(CODECS)
+
+
+def get_codec(name='json'):
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name!r}, expected one of {CODEC_CHOICES}")
+    return CODECS[name]()
+
+
+def bench(n=50000):
+    from comm.sensor import generate_reading
+
+    readings = [generate_reading(f'drone_{i:04x}_s{i:04x}') for i in range(1000)]
+    lines = [json.dumps(r).encode('utf-8') for r in readings]
+    batch = json.dumps(readings[:50]).encode('utf-8')
+    summary = {
+        "drone_id": "drone_0001",
+        "avg_temperature": 24.913333333333334,
+        "avg_pressure": 701.2566666666667,
+        "avg_altitude": 251.90333333333334,
+        "avg_motor_energies": [48.5, 51.25, 47.0, 53.75],
+        "timestamp": "2025-05-18T20:51:35Z",
+    }
+
+    def with_epoch(codec, line):
+        r = codec.decode(line)
+        if 'epoch' not in r:
+            r['epoch'] = datetime.fromisoformat(r['timestamp'].replace('Z', '+00:00')).timestamp()
+        return r
+
+    print(f"{'codec':<8} {'decode reading':>16} {'+ epoch':>16} {'encode reading':>16} "
+          f"{'decode batch/50':>16} {'encode summary':>16}")
+    for name in CODECS:
+        try:
+            codec = get_codec(name)
+        except RuntimeError as e:
+            print(f"{name:<8} skipped: {e}")
+            continue
+        k = len(lines)
+        dec = timeit.timeit(lambda: [codec.decode(line) for line in lines], number=n // k) / (n // k * k)
+        dec_ts = timeit.timeit(lambda: [with_epoch(codec, line) for line in lines], number=n // k) / (n // k * k)
+        enc = timeit.timeit(lambda: [codec.encode(r) for r in readings], number=n // k) / (n // k * k)
+        dec_batch = timeit.timeit(lambda: codec.decode(batch), number=n // 50) / (n // 50)
+        enc_summary = timeit.timeit(lambda: codec.encode(summary), number=n) / n
+        print(f"{name:<8} {dec * 1e6:>13.2f} us {dec_ts * 1e6:>13.2f} us {enc * 1e6:>13.2f} us "
+              f"{dec_batch * 1e6:>13.2f} us {enc_summary * 1e6:>13.2f} us")
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,89 @@
+import selectors
+import threading
+from comm.framing import FrameError
+
+
+class Connection:
+    __slots__ = ('sock', 'addr', 'session')
+
+    def __init__(self, sock, addr, session):
+        self.sock = sock
+        self.addr = addr
+        self.session = session
+
+
+class IngestLoop:
+    # Runs every sensor connection on one selector instead of one thread each.
+    # Several loops may share the same listening socket; whichever loop wins
+    # the accept owns that connection for its lifetime. new_session(addr)
+    # returns an object with a .framer to receive into and a .process(sock)
+    # that decodes whatever the framer has buffered.
+
+    def __init__(self, listen_sock, new_session, logger, name='ingest-0'):
+        self.listen_sock = listen_sock
+        self.new_session = new_session
+        self.logger = logger
+        self.name = name
+        self.selector = selectors.DefaultSelector()
+        self.connections = 0
+
+    def _accept(self):
+        try:
+            conn, addr = self.listen_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        state = Connection(conn, addr, self.new_session(addr))
+        self.selector.register(conn, selectors.EVENT_READ, state)
+        self.connections += 1
+        self.logger.info(f"Connection established from {addr} on {self.name}")
+
+    def _close(self, state):
+        self.selector.unregister(state.sock)
+        state.sock.close()
+        self.connections -= 1
+        self.logger.info(f"Connection closed from {state.addr}")
+
+    def _read(self, state):
+        try:
+            n = state.session.framer.recv_into(state.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (ConnectionResetError, OSError) as e:
+            self.logger.warning(f"Connection lost from {state.addr}: {e}")
+            self._close(state)
+            return
+        if not n:
+            self._close(state)
+            return
+
+        try:
+            state.session.process(state.sock)
+        except OSError as e:
+            self.logger.warning(f"Connection lost from {state.addr}: {e}")
+            self._close(state)
+        except FrameError as e:
+            self.logger.warning(f"Dropping connection from {state.addr}: {e}")
+            self._close(state)
+        except Exception as e:
+            # Whatever a session fails on only costs that connection; the
+            # loop carries on serving everyone else.
+            self.logger.error(f"Dropping connection from {state.addr} after {type(e).__name__}: {e}")
+            self._close(state)
+
+    def run(self):
+        self.selector.register(self.listen_sock, selectors.EVENT_READ, None)
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._read(key.data)
+
+
+def run_loops(listen_sock, new_session, logger, loops=1):
+    listen_sock.setblocking(False)
+    ingest_loops = [IngestLoop(listen_sock, new_session, logger, name=f'ingest-{i}') for i in range(loops)]
+    for loop in ingest_loops[1:]:
+        threading.Thread(target=loop.run, name=loop.name, daemon=True).start()
+    ingest_loops[0].run()
@@ -0,0 +1,290 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import math
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from comm.battery_manager import (
+    DRAIN_PER_SEC,
+    DRAIN_PER_READ,
+    DRAIN_PER_SEND,
+    DRAIN_MOTOR_FAC,
+    CRITICAL_LEVEL,
+    RETURN_LEVEL,
+    LOW_BATTERY,
+    RETURN_TO_BASE,
+)
+
+CAPACITY = 1024
+
+
+class FleetBattery:
+    # Battery state of a whole fleet in NumPy arrays, one slot per drone:
+    # level, last event timestamp and the flags of the events already
+    # raised. tick() advances every drone at once by the wall-clock time
+    # since the previous tick, so drones that have gone silent keep
+    # draining and still cross the return-to-base and critical levels.
+    # The same time is added to each drone's last timestamp, so when a
+    # reading does arrive only the event time not yet covered by ticks is
+    # charged (never less than zero).
+    #
+    # Events: RETURN_TO_BASE once a drone drops below RETURN_LEVEL (where
+    # summaries stop), LOW_BATTERY once it drops below CRITICAL_LEVEL
+    # (where readings are dropped). Each is raised once per drone.
+    #
+    # Also provides the BatteryBank interface, so a consumer shard can use
+    # it as its bank. Freed slots hold NaN and are reused.
+
+    def __init__(self, capacity=CAPACITY):
+        if np is None:
+            raise RuntimeError("The fleet battery engine needs numpy, which is not installed")
+        self.level = np.full(capacity, np.nan)
+        self.last_timestamp = np.full(capacity, np.nan)
+        self.returned = np.zeros(capacity, dtype=bool)
+        self.low = np.zeros(capacity, dtype=bool)
+        self.ids = []
+        self.slots = {}
+        self.free = []
+        self.clock = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, drone_id):
+        return drone_id in self.slots
+
+    def _grow(self, size):
+        capacity = len(self.level)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        extra = capacity - len(self.level)
+        self.level = np.concatenate([self.level, np.full(extra, np.nan)])
+        self.last_timestamp = np.concatenate([self.last_timestamp, np.full(extra, np.nan)])
+        self.returned = np.concatenate([self.returned, np.zeros(extra, dtype=bool)])
+        self.low = np.concatenate([self.low, np.zeros(extra, dtype=bool)])
+
+    def _slot(self, drone_id):
+        # Caller holds the lock.
+        slot = self.slots.get(drone_id)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                self.ids[slot] = drone_id
+            else:
+                slot = len(self.ids)
+                self._grow(slot + 1)
+                self.ids.append(drone_id)
+            self.slots[drone_id] = slot
+            self.level[slot] = 100.0
+            self.last_timestamp[slot] = np.nan
+            self.returned[slot] = False
+            self.low[slot] = False
+        return slot
+
+    def add(self, drone_ids):
+        # Registers many drones at once; returns their slots as an array.
+        with self.lock:
+            return np.array([self._slot(drone_id) for drone_id in drone_ids], dtype=np.intp)
+
+    def tick(self, now):
+        # Advances the fleet to wall-clock time now and returns the events
+        # raised since the previous tick as (drone_id, event, level).
+        with self.lock:
+            n = len(self.ids)
+            if self.clock is not None and now > self.clock:
+                dt = now - self.clock
+                level = self.level[:n]
+                level -= dt * DRAIN_PER_SEC
+                np.maximum(level, 0.0, out=level)
+                self.last_timestamp[:n] += dt
+            if self.clock is None or now > self.clock:
+                self.clock = now
+            return self._events(n)
+
+    def _events(self, n):
+        # Caller holds the lock. NaN (free slots) compares False.
+        level = self.level[:n]
+        events = []
+        for event, threshold, raised in ((RETURN_TO_BASE, RETURN_LEVEL, self.returned),
+                                         (LOW_BATTERY, CRITICAL_LEVEL, self.low)):
+            hit = np.flatnonzero((level < threshold) & ~raised[:n])
+            if len(hit):
+                raised[hit] = True
+                events.extend((self.ids[i], event, float(level[i])) for i in hit)
+        return events
+
+    def drain_reads(self, slots, count=1):
+        # count readings from each drone in slots (distinct), in one step.
+        # Readings from drones below CRITICAL_LEVEL are dropped and cost
+        # nothing, as in drain_batch.
+        with self.lock:
+            level = self.level[slots]
+            accepted = level >= CRITICAL_LEVEL
+            level[accepted] = np.maximum(level[accepted] - count * DRAIN_PER_READ, 0.0)
+            self.level[slots] = level
+            return accepted
+
+    def drain_sends(self, slots, avg_motor_power):
+        # One summary from each drone in slots (distinct); drones below
+        # RETURN_LEVEL skip their summary and are not charged.
+        with self.lock:
+            level = self.level[slots]
+            sent = level >= RETURN_LEVEL
+            drain = DRAIN_PER_SEND + np.asarray(avg_motor_power, dtype=float) * DRAIN_MOTOR_FAC
+            self.level[slots] = np.where(sent, np.maximum(level - drain, 0.0), level)
+            return sent
+
+    def drain_batch(self, drone_id, readings):
+        # Same contract as BatteryBank.drain_batch.
+        results = []
+        with self.lock:
+            slot = self._slot(drone_id)
+            level = float(self.level[slot])
+            last = float(self.last_timestamp[slot])
+            for ts, late in readings:
+                if not late:
+                    if not math.isnan(last):
+                        level = max(0.0, level - max(0.0, ts - last) * DRAIN_PER_SEC)
+                    last = max(ts, last) if not math.isnan(last) else ts
+                if level < CRITICAL_LEVEL:
+                    results.append((False, level))
+                    continue
+                level = max(0.0, level - DRAIN_PER_READ)
+                results.append((True, level))
+            self.level[slot] = level
+            self.last_timestamp[slot] = last
+        return results
+
+    def drain_on_send(self, drone_id, avg_motor_power):
+        with self.lock:
+            slot = self._slot(drone_id)
+            drain = DRAIN_PER_SEND + (avg_motor_power * DRAIN_MOTOR_FAC)
+            self.level[slot] = max(0.0, float(self.level[slot]) - drain)
+            return float(self.level[slot])
+
+    def get_level(self, drone_id):
+        slot = self.slots.get(drone_id)
+        return float(self.level[slot]) if slot is not None else 100.0
+
+    def check_return_to_base(self, drone_id):
+        with self.lock:
+            slot = self._slot(drone_id)
+            lvl = float(self.level[slot])
+            if lvl < RETURN_LEVEL and not self.returned[slot]:
+                self.returned[slot] = True
+                return True, lvl
+            return False, lvl
+
+    def should_enqueue(self, drone_id):
+        return self.get_level(drone_id) >= CRITICAL_LEVEL
+
+    def _state(self, slot):
+        last = float(self.last_timestamp[slot])
+        return {
+            'level': float(self.level[slot]),
+            'last_timestamp': None if math.isnan(last) else last,
+            'returned_to_base': bool(self.returned[slot]),
+        }
+
+    def peek_state(self, drone_id):
+        # No lock: see BatteryBank.peek_state.
+        slot = self.slots.get(drone_id)
+        return self._state(slot) if slot is not None else None
+
+    def export_state(self, drone_id):
+        with self.lock:
+            slot = self.slots.pop(drone_id, None)
+            if slot is None:
+                return None
+            state = self._state(slot)
+            self.level[slot] = np.nan
+            self.ids[slot] = None
+            self.free.append(slot)
+            return state
+
+    def import_state(self, drone_id, state):
+        with self.lock:
+            slot = self._slot(drone_id)
+            self.level[slot] = state['level']
+            last = state.get('last_timestamp')
+            self.last_timestamp[slot] = np.nan if last is None else last
+            self.returned[slot] = bool(state.get('returned_to_base'))
+            self.low[slot] = state['level'] < CRITICAL_LEVEL
+
+    def stats(self):
+        with self.lock:
+            n = len(self.ids)
+            level = self.level[:n]
+            live = ~np.isnan(level)
+            return {
+                'drones': len(self.slots),
+                'returning': int(np.count_nonzero(self.returned[:n] & live)),
+                'critical': int(np.count_nonzero(self.low[:n] & live)),
+                'mean_level': float(level[live].mean()) if live.any() else None,
+            }
+
+
+def simulate(drones=100000, hz=10.0, seconds=180.0, summary_interval=2.0, seed=0):
+    # Drives a simulated fleet in virtual time: every drone sends one
+    # reading per tick and one summary per summary_interval, with motor
+    # power spread over 0-100 so drones run flat at different rates.
+    # Reports the compute time per tick against the 1/hz budget.
+    rnd = np.random.default_rng(seed)
+    fleet = FleetBattery(drones)
+    slots = fleet.add(f'drone_{i}' for i in range(drones))
+    motor_power = rnd.uniform(0, 100, drones)
+    # Every drone sends in a different tick of the summary interval.
+    summary_ticks = max(1, round(summary_interval * hz))
+    send_tick = rnd.integers(0, summary_ticks, drones)
+    groups = [slots[send_tick == k] for k in range(summary_ticks)]
+    group_power = [motor_power[send_tick == k] for k in range(summary_ticks)]
+
+    ticks = int(seconds * hz)
+    counts = {RETURN_TO_BASE: 0, LOW_BATTERY: 0}
+    first = {}
+    worst = 0.0
+    start = time.perf_counter()
+    for k in range(ticks):
+        t0 = time.perf_counter()
+        now = k / hz
+        fleet.drain_reads(slots)
+        g = k % summary_ticks
+        fleet.drain_sends(groups[g], group_power[g])
+        for _, event, _ in fleet.tick(now):
+            counts[event] += 1
+            first.setdefault(event, now)
+        worst = max(worst, time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+
+    per_tick = elapsed / ticks
+    print(f"{drones} drones at {hz:g} Hz for {seconds:g}s simulated ({ticks} ticks)")
+    print(f"tick: {per_tick * 1e3:.2f} ms mean, {worst * 1e3:.2f} ms worst, budget {1e3 / hz:.1f} ms "
+          f"({'keeps up' if worst < 1 / hz else 'falls behind'}, {1 / hz / per_tick:.0f}x real time)")
+    for event in (RETURN_TO_BASE, LOW_BATTERY):
+        when = f", first at {first[event]:.1f}s" if event in first else ''
+        print(f"{event}: {counts[event]} drones{when}")
+    print(f"fleet: {fleet.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate fleet battery drain with the vectorized engine.")
+    parser.add_argument('--drones', type=int, default=100000, help='Simulated drones')
+    parser.add_argument('--hz', type=float, default=10.0, help='Ticks (and readings per drone) per second')
+    parser.add_argument('--seconds', type=float, default=180.0, help='Simulated time')
+    parser.add_argument('--summary-interval', type=float, default=2.0, help='Seconds between summaries per drone')
+    args = parser.parse_args()
+    simulate(args.drones, args.hz, args.seconds, args.summary_interval)
+
+
+if __name__ == '__main__':
+    main()
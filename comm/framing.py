@@ -0,0 +1,67 @@
+RECV_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 1024 * 1024
+
+
+class FrameError(ValueError):
+    pass
+
+
+class LineTooLong(FrameError):
+    pass
+
+
+class LineFramer:
+    # NDJSON framing over a single bytearray. Data is received straight into a
+    # preallocated chunk, newlines are located by offset (bytes already scanned
+    # are never scanned again) and consumed lines are dropped from the front of
+    # the buffer once per batch, so a burst of N lines costs O(total bytes).
+
+    def __init__(self, recv_size=RECV_SIZE, max_line=MAX_LINE_LENGTH):
+        self.buffer = bytearray()
+        self.max_line = max_line
+        self._chunk = memoryview(bytearray(recv_size))
+        self._scan = 0
+
+    def recv_into(self, sock):
+        n = sock.recv_into(self._chunk)
+        if n:
+            self.buffer += self._chunk[:n]
+        return n
+
+    def feed(self, data):
+        self.buffer += data
+
+    def lines(self):
+        buf = self.buffer
+        start = 0
+        try:
+            pos = buf.find(b'\n', self._scan)
+            while pos != -1:
+                end = pos
+                if end > start and buf[end - 1] == 13:
+                    end -= 1
+                if end - start > self.max_line:
+                    self.reset()
+                    raise LineTooLong(f"line of {end - start} bytes exceeds {self.max_line}")
+                line = buf[start:end]
+                start = pos + 1
+                if line and not line.isspace():
+                    yield line
+                pos = buf.find(b'\n', start)
+        finally:
+            if start:
+                del buf[:start]
+            self._scan = len(buf)
+
+        if len(buf) > self.max_line:
+            pending = len(buf)
+            self.reset()
+            raise LineTooLong(f"unterminated line of {pending} bytes exceeds {self.max_line}")
+
+    def consume(self, n):
+        del self.buffer[:n]
+        self._scan = 0
+
+    def reset(self):
+        self.buffer.clear()
+        self._scan = 0
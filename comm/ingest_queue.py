@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import defaultdict, deque
+from queue import Empty
+from comm.readings import drone_id_of
+
+QUEUE_SIZE = 10000
+POLICIES = ('block', 'drop_oldest', 'drop_newest', 'drop_fair')
+
+
+def weight(item):
+    return len(item) if isinstance(item, list) else 1
+
+
+class IngestQueue:
+    # Bounded replacement for queue.Queue between the ingest side and the
+    # consumer. Items are single readings or batches (lists of readings from
+    # one sensor); capacity is counted in items, drops in readings. When
+    # full, the policy decides what happens to a new item:
+    #   block       - the reader waits, which stops it reading its socket and
+    #                 pushes TCP backpressure back to the sensors
+    #   drop_oldest - evict the oldest queued item to make room
+    #   drop_newest - reject the incoming item
+    #   drop_fair   - evict the oldest item of the drone holding the most
+    #                 slots; items are also served round-robin across drones
+    #                 so one chatty drone cannot starve the rest
+
+    def __init__(self, maxsize=QUEUE_SIZE, policy='block'):
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+        self.unfinished_tasks = 0
+        self.depth = 0
+        self.depth_by_drone = defaultdict(int)
+        self.enqueued = 0
+        self.blocked = 0
+        self.dropped_by_drone = defaultdict(int)
+        self.items = deque()
+        self.per_drone = {}
+        self.ready = deque()
+        self.configure(maxsize, policy)
+
+    def configure(self, maxsize=QUEUE_SIZE, policy='block'):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy!r}, expected one of {POLICIES}")
+        with self.mutex:
+            if self.depth:
+                raise RuntimeError("Cannot reconfigure a non-empty queue")
+            self.maxsize = maxsize
+            self.policy = policy
+
+    def qsize(self):
+        with self.mutex:
+            return self.depth
+
+    def _append(self, drone_id, item):
+        if self.policy == 'drop_fair':
+            q = self.per_drone.get(drone_id)
+            if q is None:
+                q = self.per_drone[drone_id] = deque()
+            if not q:
+                self.ready.append(drone_id)
+            q.append(item)
+        else:
+            self.items.append((drone_id, item))
+        self.depth += 1
+        self.depth_by_drone[drone_id] += 1
+
+    def _pop(self):
+        if self.policy == 'drop_fair':
+            drone_id = self.ready.popleft()
+            q = self.per_drone[drone_id]
+            item = q.popleft()
+            if q:
+                self.ready.append(drone_id)
+            else:
+                del self.per_drone[drone_id]
+        else:
+            drone_id, item = self.items.popleft()
+        self._forget(drone_id)
+        return item
+
+    def _forget(self, drone_id):
+        self.depth -= 1
+        left = self.depth_by_drone[drone_id] - 1
+        if left:
+            self.depth_by_drone[drone_id] = left
+        else:
+            del self.depth_by_drone[drone_id]
+
+    def _evict_fair(self, incoming):
+        share = self.maxsize // max(1, len(self.per_drone))
+        victim = incoming
+        if self.depth_by_drone.get(incoming, 0) < share:
+            victim = max(self.depth_by_drone, key=self.depth_by_drone.get)
+        q = self.per_drone[victim]
+        dropped = q.popleft()
+        if not q:
+            del self.per_drone[victim]
+            self.ready.remove(victim)
+        self._forget(victim)
+        self.dropped_by_drone[victim] += weight(dropped)
+        self.unfinished_tasks -= 1
+
+    def put(self, item, block=True, timeout=None):
+        drone_id = drone_id_of(item[0] if isinstance(item, list) else item)
+        with self.not_full:
+            if self.maxsize > 0 and self.depth >= self.maxsize:
+                if self.policy == 'block' and block:
+                    self.blocked += 1
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    while self.depth >= self.maxsize:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            self.dropped_by_drone[drone_id] += weight(item)
+                            return False
+                        self.not_full.wait(remaining)
+                elif self.policy == 'drop_oldest':
+                    victim, dropped = self.items.popleft()
+                    self._forget(victim)
+                    self.dropped_by_drone[victim] += weight(dropped)
+                    self.unfinished_tasks -= 1
+                elif self.policy == 'drop_fair':
+                    self._evict_fair(drone_id)
+                else:
+                    self.dropped_by_drone[drone_id] += weight(item)
+                    return False
+
+            self._append(drone_id, item)
+            self.enqueued += 1
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self.depth:
+                    raise Empty
+            elif timeout is None:
+                while not self.depth:
+                    self.not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self.depth:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            item = self._pop()
+            self.not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - 1
+            if unfinished <= 0:
+                if unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                self.all_tasks_done.notify_all()
+            self.unfinished_tasks = unfinished
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'policy': self.policy,
+                'maxsize': self.maxsize,
+                'depth': self.depth,
+                'enqueued': self.enqueued,
+                'blocked': self.blocked,
+                'dropped': sum(self.dropped_by_drone.values()),
+                'depth_by_drone': dict(self.depth_by_drone),
+                'dropped_by_drone': dict(self.dropped_by_drone),
+            }
@@ -0,0 +1,27 @@
+import zlib
+
+def is_reading(value):
+    # What ingest accepts as a reading: an object whose sensor_id (and
+    # drone_id, if set) is a string, since both are split and hashed to
+    # route it.
+    return (isinstance(value, dict) and isinstance(value.get('sensor_id'), str)
+            and isinstance(value.get('drone_id') or '', str))
+
+def drop_epoch(item):
+    # 'epoch' is only trusted from decoders that compute it themselves (the
+    # binary protocol and the schema codec); an NDJSON client could put any
+    # value under that key.
+    for r in item if isinstance(item, list) else (item,):
+        if isinstance(r, dict):
+            r.pop('epoch', None)
+
+def drone_id_of(reading):
+    drone_id = reading.get('drone_id')
+    if drone_id:
+        return drone_id
+    return '_'.join(reading.get('sensor_id', '').split('_')[:2])
+
+def shard_of(drone_id, shards):
+    # crc32 rather than hash(): str hashes are salted per process, and every
+    # process has to agree on which shard owns a drone.
+    return zlib.crc32(drone_id.encode('utf-8')) % shards
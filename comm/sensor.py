@@ -8,11 +8,17 @@ import argparse
 import random
 from datetime import datetime
 import os
+from comm.binary_protocol import (
+    MAGIC, WELCOME_FRAME, MAX_BATCH, encode_hello, decode_welcome, encode_reading, encode_batch
+)
+import logger as log_config
 from logger import setup_logger
 
 MAX_BACKOFF = 16
 INITIAL_BACKOFF = 1
 SEND_INTERVAL = 2
+# Largest UDP payload over IPv4; bigger datagrams fail with EMSGSIZE.
+MAX_DATAGRAM = 65507
 
 def generate_reading(sensor_id: str) -> dict:
     return {
@@ -25,27 +31,115 @@ def generate_reading(sensor_id: str) -> dict:
         "timestamp": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
     }
 
+def recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionResetError("connection closed during handshake")
+        data += chunk
+    return data
+
+def connect(host, port, sensor_id, protocol, transport='tcp'):
+    if transport == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        return sock, None
+    sock = socket.create_connection((host, port), timeout=5)
+    if protocol != 'binary':
+        return sock, None
+    try:
+        sock.sendall(MAGIC + encode_hello(sensor_id))
+        return sock, decode_welcome(recv_exact(sock, WELCOME_FRAME.size))
+    except Exception:
+        sock.close()
+        raise
+
+def largest_reading(sensor_id):
+    # Encoded size of the widest reading generate_reading() can produce
+    # (with the UDP sequence number), used to bound batches up front.
+    reading = {
+        "sensor_id": sensor_id,
+        "temperature": -10.55,
+        "humidity": 10.55,
+        "pressure": 1099.55,
+        "altitude": 499.55,
+        "motor_energies": [100] * 4,
+        "timestamp": '2000-01-01T00:00:00Z',
+        "seq": 2 ** 63,
+    }
+    return len(json.dumps(reading))
+
+def max_udp_batch(sensor_id):
+    # '[' + readings joined by ', ' + ']\n' must fit one datagram.
+    return (MAX_DATAGRAM - 1) // (largest_reading(sensor_id) + 2)
+
+def udp_payloads(pending):
+    # Splits a batch into as few datagrams as fit under MAX_DATAGRAM each.
+    chunk, size = [], 1
+    for _, reading in pending:
+        n = len(json.dumps(reading)) + 2
+        if chunk and size + n > MAX_DATAGRAM:
+            yield (json.dumps(chunk) + '\n').encode('utf-8')
+            chunk, size = [], 1
+        chunk.append(reading)
+        size += n
+    if chunk:
+        yield (json.dumps(chunk) + '\n').encode('utf-8')
+
+def encode_payload(protocol, sid, pending, batched):
+    if protocol == 'binary':
+        if batched:
+            return encode_batch(sid, [r for _, r in pending], [ts for ts, _ in pending])
+        ts, reading = pending[0]
+        return encode_reading(sid, reading, ts)
+    if batched:
+        return (json.dumps([r for _, r in pending]) + '\n').encode('utf-8')
+    return (json.dumps(pending[0][1]) + '\n').encode('utf-8')
+
 def main():
     parser = argparse.ArgumentParser(description="Sensor node sending data to the drone.")
     parser.add_argument('--host', required=True, help='Drone server IP')
     parser.add_argument('--port', type=int, required=True, help='Drone server port')
     parser.add_argument('--sensor-id', default='sensor1', help='Unique sensor identifier')
+    parser.add_argument('--protocol', choices=['ndjson', 'binary'], default='ndjson',
+                        help='Wire format: NDJSON lines or compact binary frames')
+    parser.add_argument('--interval', type=float, default=SEND_INTERVAL, help='Seconds between readings')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Send readings in batches of this many (1 = one frame per reading)')
+    parser.add_argument('--batch-interval', type=float, default=0.0,
+                        help='Also flush a partial batch once its oldest reading is this many seconds old')
+    parser.add_argument('--transport', choices=['tcp', 'udp'], default='tcp',
+                        help='tcp: persistent connection; udp: fire-and-forget datagrams (ndjson only)')
+    log_config.add_arguments(parser)
     args = parser.parse_args()
+    if not 1 <= args.batch_size <= MAX_BATCH:
+        parser.error(f"--batch-size must be between 1 and {MAX_BATCH}")
+    if args.transport == 'udp' and args.protocol == 'binary':
+        parser.error("--transport udp only supports --protocol ndjson")
+    if args.transport == 'udp' and args.batch_size > max_udp_batch(args.sensor_id):
+        parser.error(f"--batch-size {args.batch_size} does not fit a UDP datagram; "
+                     f"at most {max_udp_batch(args.sensor_id)} readings for this sensor id")
+    batched = args.batch_size > 1 or args.batch_interval > 0
 
     host, port = args.host, args.port
     sensor_id = args.sensor_id
 
+    log_config.apply_arguments(args)
     logger = setup_logger(sensor_id, f'logs/sensors/{sensor_id}.log')
     logger.info(f"Sensor {sensor_id} started. Target = {host}:{port}")
 
     backoff = INITIAL_BACKOFF
     sock = None
+    sid = None
+    pending = []
+    seq = 0
 
     while True:
         if sock is None:
             try:
-                sock = socket.create_connection((host, port), timeout=5)
-                logger.info(f"Connected to drone at {host}:{port}")
+                sock, sid = connect(host, port, sensor_id, args.protocol, args.transport)
+                logger.info(f"Connected to drone at {host}:{port} ({args.protocol} over {args.transport})")
                 backoff = INITIAL_BACKOFF
             except (ConnectionRefusedError, socket.timeout):
                 logger.warning(f"Couldn't connect, retrying in {backoff} seconds")
@@ -58,10 +152,31 @@ def main():
                 backoff = min(MAX_BACKOFF, backoff * 2)
                 continue
 
+        now = time.time()
         reading = generate_reading(sensor_id)
+        if args.transport == 'udp':
+            reading['seq'] = seq
+            seq += 1
+        pending.append((now, reading))
+        batch_due = len(pending) >= args.batch_size or (
+            args.batch_interval > 0 and now - pending[0][0] >= args.batch_interval)
+        if batched and not batch_due:
+            time.sleep(args.interval)
+            continue
+
         try:
-            sock.sendall((json.dumps(reading) + '\n').encode('utf-8'))
-            logger.info(f"Sent data: {json.dumps(reading)}")
+            if args.transport == 'udp' and batched:
+                # Split by encoded size too, in case a reading is wider
+                # than largest_reading() allows for.
+                for payload in udp_payloads(pending):
+                    sock.sendall(payload)
+            else:
+                sock.sendall(encode_payload(args.protocol, sid, pending, batched))
+            if batched:
+                logger.info(f"Sent batch of {len(pending)} readings")
+            else:
+                logger.info(f"Sent data: {json.dumps(pending[0][1])}")
+            pending = []
         except (BrokenPipeError, ConnectionResetError, OSError):
             logger.warning("Connection lost, retrying")
             try:
@@ -69,9 +184,13 @@ def main():
             except Exception:
                 pass
             sock = None
+            # Keep room for the reading the next pass adds, so no frame
+            # ever carries more than batch_size readings.
+            keep = args.batch_size - 1 if batched else 0
+            pending = pending[max(0, len(pending) - keep):] if keep else []
             continue
 
-        time.sleep(SEND_INTERVAL)
+        time.sleep(args.interval)
 
 if __name__ == '__main__':
     main()
@@ -3,55 +3,339 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import socket
 import threading
+import time
 import json
-from queue import Queue
-from anomaly.consumer import start_consumer
+import argparse
+import multiprocessing
+import signal
+from anomaly.consumer import start_consumer, set_rules, configure_state
+from anomaly.event_time import REORDER_DELAY, ALLOWED_LATENESS
+from anomaly.state import DRONE_TTL, MAX_DRONES, MAX_OPEN_LOGS
+from anomaly import snapshot
+from comm.event_loop import run_loops
+from comm.framing import LineFramer, FrameError, RECV_SIZE, MAX_LINE_LENGTH
+from comm.binary_protocol import MAGIC, BinaryDecoder
+from comm.codec import get_codec, CODEC_CHOICES
+from comm.central_client import set_codec as set_uplink_codec, configure as configure_uplink
+from comm import central_client
+from comm import uplink
+from comm.ingest_queue import IngestQueue, QUEUE_SIZE, POLICIES
+from comm.readings import drone_id_of, shard_of, is_reading, drop_epoch
+from comm.udp import UdpListener
+import logger as log_config
 from logger import setup_logger
 
 main_logger = setup_logger('main_server', 'logs/server/main.log')
 
-sensor_queue = Queue()
+sensor_queue = IngestQueue()
+codec = get_codec('json')
 HOST = '0.0.0.0'
 PORT = 5000
+STATS_INTERVAL = 10.0
 
-def handle_client(conn, addr):
+# Set in each worker process when running with --workers > 1.
+worker_index = 0
+worker_inboxes = None
+udp_listener = None
+
+def submit(item):
+    # In multi-process mode every drone is owned by exactly one worker, so
+    # its anomaly window and battery state live in one place. Readings
+    # accepted by another worker's socket are handed off to the owner.
+    if worker_inboxes is not None:
+        first = item[0] if isinstance(item, list) else item
+        if not is_reading(first):
+            main_logger.warning(f"Dropping invalid reading instead of handing it off: {first!r}")
+            return False
+        owner = shard_of(drone_id_of(first), len(worker_inboxes))
+        if owner != worker_index:
+            worker_inboxes[owner].put(item)
+            return True
+    return sensor_queue.put(item)
+
+def enqueue(item):
+    # A batch (list of readings) is one queue item and one log line.
+    if isinstance(item, list):
+        if item and submit(item):
+            main_logger.info(f"Enqueued batch of {len(item)} readings from {item[0].get('sensor_id')}")
+    elif submit(item):
+        main_logger.info(f"Enqueued reading from {item.get('sensor_id')}")
+
+def decode_line(line):
+    item = codec.decode(line)
+    if not codec.sets_epoch:
+        drop_epoch(item)
+    return item
+
+def handle_line(line, addr):
+    try:
+        item = decode_line(line)
+    except ValueError as e:
+        main_logger.warning(f"JSON decode error: {e} | line: {line.decode('utf-8', errors='replace')}")
+        return
+    if isinstance(item, list):
+        readings = [r for r in item if is_reading(r)]
+        if len(readings) < len(item):
+            main_logger.warning(f"Dropped {len(item) - len(readings)} invalid readings of a batch from {addr}")
+        item = readings
+    elif not is_reading(item):
+        main_logger.warning(f"Invalid reading from {addr}: {line.decode('utf-8', errors='replace')}")
+        return
+    enqueue(item)
+
+class SensorSession:
+    # Per-connection state shared by the threaded and event-loop modes. The
+    # first byte decides the protocol: binary connections open with MAGIC
+    # (a NUL byte), anything else is NDJSON.
+
+    def __init__(self, addr, recv_size=RECV_SIZE, max_line=MAX_LINE_LENGTH):
+        self.addr = addr
+        self.framer = LineFramer(recv_size, max_line)
+        self.protocol = None
+        self.decoder = None
+
+    def process(self, conn):
+        if self.protocol is None:
+            if self.framer.buffer[:1] == MAGIC[:1]:
+                self.protocol = 'binary'
+                self.decoder = BinaryDecoder(self.framer)
+            else:
+                self.protocol = 'ndjson'
+            main_logger.info(f"Connection from {self.addr} speaks {self.protocol}")
+
+        if self.decoder is not None:
+            for item in self.decoder.decode(conn.sendall):
+                enqueue(item)
+        else:
+            for line in self.framer.lines():
+                handle_line(line, self.addr)
+
+def handle_client(conn, addr, recv_size=RECV_SIZE, max_line=MAX_LINE_LENGTH):
     main_logger.info(f"Connection established from {addr}")
-    buffer = ''
+    session = SensorSession(addr, recv_size, max_line)
     with conn:
         while True:
             try:
-                data = conn.recv(1024)
-                if not data:
+                if not session.framer.recv_into(conn):
                     break
-                buffer += data.decode('utf-8', errors='replace')
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if not line.strip():
-                        continue
-                    try:
-                        reading = json.loads(line)
-                        sensor_queue.put(reading)
-                        main_logger.info(f"Enqueued reading from {reading.get('sensor_id')}")
-                    except json.JSONDecodeError as e:
-                        main_logger.warning(f"JSON decode error: {e} | line: {line}")
+                session.process(conn)
+            except FrameError as e:
+                main_logger.warning(f"Dropping connection from {addr}: {e}")
+                break
             except (ConnectionResetError, OSError) as e:
                 main_logger.warning(f"Connection lost from {addr}: {e}")
                 break
     main_logger.info(f"Connection closed from {addr}")
 
-def serve():
-    start_consumer(sensor_queue)
+def start_queue_reporter(interval=STATS_INTERVAL):
+    prefix = f"[worker {worker_index}] " if worker_inboxes is not None else ''
+
+    def report_loop():
+        last_dropped = 0
+        while True:
+            time.sleep(interval)
+            stats = sensor_queue.stats()
+            msg = (f"{prefix}Ingest queue depth {stats['depth']}/{stats['maxsize']} ({stats['policy']}), "
+                   f"enqueued {stats['enqueued']}, blocked {stats['blocked']}, dropped {stats['dropped']}")
+            if stats['dropped'] > last_dropped:
+                main_logger.warning(f"{msg}; drops by drone: {json.dumps(stats['dropped_by_drone'])}")
+            else:
+                main_logger.info(msg)
+            last_dropped = stats['dropped']
+
+            if udp_listener is not None:
+                udp = udp_listener.tracker.totals()
+                main_logger.info(
+                    f"{prefix}UDP ingest: {udp['sensors']} sensors, received {udp['received']}, "
+                    f"lost {udp['lost']}, reordered {udp['reordered']}, duplicates {udp['duplicates']}, "
+                    f"invalid datagrams {udp_listener.invalid}")
+
+            up = uplink.stats()
+            if up is not None:
+                log = main_logger.warning if up['down'] else main_logger.info
+                log(f"{prefix}Uplink: sent {up['sent']}, queued {up['queued']}, spooled {up['spooled']}, "
+                    f"spilled {up['spilled']}{', central unreachable' if up['down'] else ''}")
+
+    threading.Thread(target=report_loop, daemon=True).start()
+
+def start_handoff(inbox):
+    def handoff_loop():
+        while True:
+            sensor_queue.put(inbox.get())
+
+    threading.Thread(target=handoff_loop, daemon=True).start()
+
+def worker_main(index, inboxes, options):
+    global worker_index, worker_inboxes
+    worker_index = index
+    worker_inboxes = inboxes
+    serve(**options)
+
+def serve_workers(workers, **options):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError("--workers needs SO_REUSEPORT, which this platform does not provide")
+    inboxes = [multiprocessing.Queue(options.get('queue_size', QUEUE_SIZE)) for _ in range(workers)]
+    procs = [
+        multiprocessing.Process(target=worker_main, args=(i, inboxes, options), name=f'drone-worker-{i}')
+        for i in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+
+    def stop_workers(signum, frame):
+        for proc in procs:
+            proc.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    main_logger.info(f"Started {workers} ingest workers sharing port {options.get('port', PORT)}")
+    for proc in procs:
+        proc.join()
+
+def serve(mode='threaded', loops=1, host=HOST, port=PORT, recv_size=RECV_SIZE, max_line=MAX_LINE_LENGTH,
+          queue_size=QUEUE_SIZE, queue_policy='block', workers=1, codec_name='json', uplink_codec='json',
+          udp_port=None, consumers=1, consumer_backend='thread', vector_batch=0, rules=None,
+          reorder_delay=REORDER_DELAY, allowed_lateness=ALLOWED_LATENESS,
+          central_host=central_client.HOST, central_port=central_client.PORT,
+          uplink_pool=central_client.POOL_SIZE, spool_dir=uplink.SPOOL_DIR, uplink_queue=uplink.QUEUE_SIZE,
+          drone_ttl=DRONE_TTL, max_drones=MAX_DRONES, max_open_logs=MAX_OPEN_LOGS, battery_checkpoints=None,
+          battery_engine='bank', snapshot_dir=None, snapshot_interval=snapshot.SNAPSHOT_INTERVAL):
+    global codec, udp_listener
+    if workers > 1:
+        serve_workers(workers, mode=mode, loops=loops, host=host, port=port, recv_size=recv_size,
+                      max_line=max_line, queue_size=queue_size, queue_policy=queue_policy,
+                      codec_name=codec_name, uplink_codec=uplink_codec, udp_port=udp_port,
+                      consumers=consumers, consumer_backend=consumer_backend, vector_batch=vector_batch,
+                      rules=rules, reorder_delay=reorder_delay, allowed_lateness=allowed_lateness,
+                      central_host=central_host, central_port=central_port, uplink_pool=uplink_pool,
+                      spool_dir=spool_dir, uplink_queue=uplink_queue, drone_ttl=drone_ttl, max_drones=max_drones,
+                      max_open_logs=max_open_logs, battery_checkpoints=battery_checkpoints,
+                      battery_engine=battery_engine, snapshot_dir=snapshot_dir,
+                      snapshot_interval=snapshot_interval)
+        return
+
+    codec = get_codec(codec_name)
+    set_uplink_codec(uplink_codec)
+    configure_uplink(central_host, central_port, uplink_pool)
+    uplink.configure(spool_dir, f'worker-{worker_index}' if worker_inboxes is not None else 'main', uplink_queue)
+    if rules is not None:
+        set_rules(rules)
+
+    sensor_queue.configure(queue_size, queue_policy)
+    configure_state(drone_ttl, max_drones, max_open_logs, battery_checkpoints, battery_engine)
+    snapshot.configure(snapshot_dir, f'worker-{worker_index}' if worker_inboxes is not None else 'main',
+                       snapshot_interval, worker_index, len(worker_inboxes) if worker_inboxes is not None else 1)
+    start_consumer(sensor_queue, workers=consumers, backend=consumer_backend, batch_size=vector_batch,
+                   reorder_delay=reorder_delay, allowed_lateness=allowed_lateness)
+    if worker_inboxes is not None:
+        start_handoff(worker_inboxes[worker_index])
+    if udp_port:
+        udp_listener = UdpListener(host, udp_port, decode_line, enqueue, main_logger,
+                                   reuse_port=worker_inboxes is not None)
+        udp_listener.start()
+        main_logger.info(f"UDP ingest listening on {host}:{udp_port}")
+    start_queue_reporter()
     main_logger.info("Anomaly and aggregator threads started")
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((HOST, PORT))
-        sock.listen()
-        main_logger.info(f"Main server listening on {HOST}:{PORT}")
+        if worker_inboxes is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+        main_logger.info(f"Main server listening on {host}:{port} ({mode} mode, worker {worker_index})")
+
+        if mode == 'eventloop':
+            new_session = lambda addr: SensorSession(addr, recv_size, max_line)
+            run_loops(sock, new_session, main_logger, loops=loops)
+            return
 
         while True:
             conn, addr = sock.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+            threading.Thread(target=handle_client, args=(conn, addr, recv_size, max_line), daemon=True).start()
+
+def main():
+    parser = argparse.ArgumentParser(description="Drone server receiving sensor readings.")
+    parser.add_argument('--host', default=HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+    parser.add_argument('--mode', choices=['threaded', 'eventloop'], default='threaded',
+                        help='threaded: one thread per sensor; eventloop: sensors multiplexed on selector loops')
+    parser.add_argument('--loops', type=int, default=1,
+                        help='Number of event loops in eventloop mode (0 = one per CPU); loops are threads '
+                             'sharing the GIL, so use --workers to scale across cores')
+    parser.add_argument('--recv-size', type=int, default=RECV_SIZE, help='Socket receive buffer size in bytes')
+    parser.add_argument('--max-line', type=int, default=MAX_LINE_LENGTH,
+                        help='Longest accepted NDJSON line; longer lines drop the connection')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='Maximum readings waiting for the consumer (0 = unbounded)')
+    parser.add_argument('--queue-policy', choices=POLICIES, default='block',
+                        help='What to do when the ingest queue is full')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Ingest/consumer processes sharing the port via SO_REUSEPORT (0 = one per CPU)')
+    parser.add_argument('--codec', choices=CODEC_CHOICES, default='json',
+                        help='Decoder for NDJSON sensor lines (auto = orjson if installed, else json)')
+    parser.add_argument('--uplink-codec', choices=CODEC_CHOICES, default='json',
+                        help='Encoder for summaries sent to the central server')
+    parser.add_argument('--central-host', default=central_client.HOST, help='Central server address')
+    parser.add_argument('--central-port', type=int, default=central_client.PORT, help='Central server port')
+    parser.add_argument('--uplink-pool', type=int, default=central_client.POOL_SIZE,
+                        help='Persistent connections kept open to the central server')
+    parser.add_argument('--spool-dir', default=uplink.SPOOL_DIR,
+                        help='Where summaries are spooled while the central server is unreachable')
+    parser.add_argument('--uplink-queue', type=int, default=uplink.QUEUE_SIZE,
+                        help='Summaries held in memory for the uplink before spilling to the spool')
+    parser.add_argument('--drone-ttl', type=float, default=DRONE_TTL,
+                        help='Drop a drone\'s windows, summaries and battery state after this many idle seconds (0 = never)')
+    parser.add_argument('--max-drones', type=int, default=MAX_DRONES,
+                        help='Drones each consumer shard keeps state for, least recently used evicted first (0 = no limit)')
+    parser.add_argument('--max-open-logs', type=int, default=MAX_OPEN_LOGS,
+                        help='Drone log files kept open; older ones are closed and reopened on demand (0 = no limit)')
+    parser.add_argument('--battery-checkpoints', default=None,
+                        help='Directory to save evicted drones\' battery state in, restored when they return')
+    parser.add_argument('--battery-engine', choices=('bank', 'fleet'), default='bank',
+                        help='fleet: keep battery levels in numpy arrays and drain every drone each tick, '
+                             'including drones that stopped reporting')
+    parser.add_argument('--snapshot-dir', default=None,
+                        help='Periodically snapshot battery state, windows and pending summaries here, '
+                             'and restore from it on start')
+    parser.add_argument('--snapshot-interval', type=float, default=snapshot.SNAPSHOT_INTERVAL,
+                        help='Seconds between snapshots')
+    parser.add_argument('--udp-port', type=int, default=None,
+                        help='Also accept fire-and-forget readings as UDP datagrams on this port')
+    parser.add_argument('--consumers', type=int, default=1,
+                        help='Anomaly consumer shards, each owning the drones hashed to it')
+    parser.add_argument('--consumer-backend', choices=['thread', 'process'], default='thread',
+                        help='Run consumer shards as threads or as processes (to get past the GIL)')
+    parser.add_argument('--vector-batch', type=int, default=0,
+                        help='Drain up to this many queue items at once and detect anomalies with numpy (0 = off)')
+    parser.add_argument('--rules', default=None,
+                        help='Anomaly rule file (JSON, or YAML with PyYAML); default anomaly/rules.json')
+    parser.add_argument('--reorder-delay', type=float, default=REORDER_DELAY,
+                        help='Seconds of event time to hold readings so out-of-order ones can be put back in '
+                             'order; also delays every summary by this much')
+    parser.add_argument('--allowed-lateness', type=float, default=ALLOWED_LATENESS,
+                        help='Seconds behind the watermark a reading may arrive and still be counted; a summary '
+                             'is sent once reorder delay + allowed lateness (7 s by default) have passed after '
+                             'its bucket ends')
+    log_config.add_arguments(parser)
+    args = parser.parse_args()
+    # The per-reading INFO lines: ingest in the server log, acceptance in
+    # each drone's log.
+    log_config.apply_arguments(args, hot_loggers=('main_server', 'drone*'))
+
+    loops = args.loops if args.loops > 0 else (os.cpu_count() or 1)
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    serve(mode=args.mode, loops=loops, host=args.host, port=args.port,
+          recv_size=args.recv_size, max_line=args.max_line,
+          queue_size=args.queue_size, queue_policy=args.queue_policy, workers=workers,
+          codec_name=args.codec, uplink_codec=args.uplink_codec, udp_port=args.udp_port,
+          consumers=args.consumers, consumer_backend=args.consumer_backend, vector_batch=args.vector_batch,
+          rules=args.rules, reorder_delay=args.reorder_delay, allowed_lateness=args.allowed_lateness,
+          central_host=args.central_host, central_port=args.central_port, uplink_pool=args.uplink_pool,
+          spool_dir=args.spool_dir, uplink_queue=args.uplink_queue, drone_ttl=args.drone_ttl,
+          max_drones=args.max_drones, max_open_logs=args.max_open_logs, battery_checkpoints=args.battery_checkpoints,
+          battery_engine=args.battery_engine, snapshot_dir=args.snapshot_dir,
+          snapshot_interval=args.snapshot_interval)
 
 if __name__ == '__main__':
-    serve()
+    main()
@@ -0,0 +1,127 @@
+import socket
+import threading
+from comm.readings import is_reading
+
+MAX_DATAGRAM = 65535
+# A sequence number this far behind the highest seen means the sensor
+# restarted and began counting from zero again.
+RESTART_GAP = 1000
+
+
+class SequenceState:
+    __slots__ = ('highest', 'received', 'lost', 'reordered', 'duplicates')
+
+    def __init__(self, seq):
+        self.highest = seq
+        self.received = 1
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+
+
+class SequenceTracker:
+    # Counts loss and reordering per sensor from the 'seq' field UDP sensors
+    # stamp on every reading. A gap is counted as lost when it opens; a late
+    # reading that fills it moves it from lost to reordered.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sensors = {}
+
+    def observe(self, sensor_id, seq):
+        with self.lock:
+            st = self.sensors.get(sensor_id)
+            if st is None or seq < st.highest - RESTART_GAP:
+                self.sensors[sensor_id] = SequenceState(seq)
+                return
+            st.received += 1
+            if seq > st.highest:
+                st.lost += seq - st.highest - 1
+                st.highest = seq
+            elif seq == st.highest or st.lost == 0:
+                st.duplicates += 1
+            else:
+                st.lost -= 1
+                st.reordered += 1
+
+    def totals(self):
+        with self.lock:
+            states = list(self.sensors.values())
+        return {
+            'sensors': len(states),
+            'received': sum(st.received for st in states),
+            'lost': sum(st.lost for st in states),
+            'reordered': sum(st.reordered for st in states),
+            'duplicates': sum(st.duplicates for st in states),
+        }
+
+    def stats(self):
+        with self.lock:
+            return {
+                sensor_id: {
+                    'received': st.received,
+                    'lost': st.lost,
+                    'reordered': st.reordered,
+                    'duplicates': st.duplicates,
+                }
+                for sensor_id, st in self.sensors.items()
+            }
+
+
+class UdpListener:
+    # One datagram carries one reading or one batch (a JSON array), each
+    # reading stamped with a per-sensor 'seq'. There is no connection state,
+    # so a single thread serves every UDP sensor.
+
+    def __init__(self, host, port, decode, enqueue, logger, reuse_port=False):
+        self.decode = decode
+        self.enqueue = enqueue
+        self.logger = logger
+        self.tracker = SequenceTracker()
+        self.invalid = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((host, port))
+
+    def _track(self, reading):
+        seq = reading.get('seq')
+        if isinstance(seq, int):
+            self.tracker.observe(reading.get('sensor_id', ''), seq)
+
+    def run(self):
+        buf = bytearray(MAX_DATAGRAM)
+        view = memoryview(buf)
+        while True:
+            try:
+                n, addr = self.sock.recvfrom_into(view)
+            except OSError as e:
+                self.logger.warning(f"UDP receive error: {e}")
+                continue
+            try:
+                item = self.decode(bytes(view[:n]))
+            except ValueError as e:
+                self.invalid += 1
+                self.logger.warning(f"Invalid UDP datagram from {addr}: {e}")
+                continue
+
+            if isinstance(item, list):
+                readings = [r for r in item if is_reading(r)]
+                if len(readings) < len(item):
+                    self.invalid += 1
+                    self.logger.warning(f"Dropped {len(item) - len(readings)} invalid readings of a "
+                                        f"datagram from {addr}")
+                item = readings
+                for reading in item:
+                    self._track(reading)
+            elif is_reading(item):
+                self._track(item)
+            else:
+                self.invalid += 1
+                self.logger.warning(f"Invalid reading in UDP datagram from {addr}")
+                continue
+            self.enqueue(item)
+
+    def start(self):
+        threading.Thread(target=self.run, name='udp-ingest', daemon=True).start()
@@ -0,0 +1,243 @@
+import os
+import threading
+import time
+from collections import deque
+from comm import central_client
+from logger import setup_logger
+
+SPOOL_DIR = 'spool'
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+SEGMENT_SIZE = 4 * 1024 * 1024
+RETRY_MIN = 0.5
+RETRY_MAX = 30.0
+
+uplink_logger = setup_logger('uplink', 'logs/server/uplink.log')
+
+
+class SegmentSpool:
+    # Append-only on-disk queue of encoded NDJSON records, split into
+    # numbered segment files of about SEGMENT_SIZE bytes. The read position
+    # (segment number and byte offset) is saved in a small cursor file after
+    # every acknowledged batch, and fully sent segments are deleted, so
+    # records survive a restart and are replayed from where sending stopped.
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+        segments = sorted(int(name[:-7]) for name in os.listdir(path) if name.endswith('.ndjson'))
+        self.read_segment, self.read_offset = self._load_cursor(segments)
+        self.write_segment = segments[-1] if segments else self.read_segment
+        self.writer = None
+        self.records = 0
+        for seg in segments:
+            if seg >= self.read_segment:
+                self.records += self._count(seg, self.read_offset if seg == self.read_segment else 0)
+
+    def _file(self, seg):
+        return os.path.join(self.path, f'{seg:08d}.ndjson')
+
+    def _load_cursor(self, segments):
+        try:
+            with open(os.path.join(self.path, 'cursor'), 'r') as f:
+                seg, offset = (int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            return (segments[0] if segments else 0), 0
+        if segments and seg < segments[0]:
+            return segments[0], 0
+        return seg, offset
+
+    def _save_cursor(self):
+        tmp = os.path.join(self.path, 'cursor.tmp')
+        with open(tmp, 'w') as f:
+            f.write(f'{self.read_segment} {self.read_offset}\n')
+        os.replace(tmp, os.path.join(self.path, 'cursor'))
+
+    def _count(self, seg, offset):
+        try:
+            with open(self._file(seg), 'rb') as f:
+                f.seek(offset)
+                return sum(1 for line in f if line.endswith(b'\n'))
+        except OSError:
+            return 0
+
+    def __len__(self):
+        return self.records
+
+    def append(self, lines):
+        if self.writer is None:
+            self.writer = open(self._file(self.write_segment), 'ab')
+        self.writer.write(b''.join(lines))
+        self.writer.flush()
+        self.records += len(lines)
+        if self.writer.tell() >= self.segment_size:
+            self.writer.close()
+            self.writer = None
+            self.write_segment += 1
+
+    def peek(self, limit):
+        # Up to limit complete records from the read position, and where the
+        # read position will be once they are acknowledged.
+        seg, offset = self.read_segment, self.read_offset
+        lines = []
+        while len(lines) < limit and seg <= self.write_segment:
+            try:
+                with open(self._file(seg), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        lines.append(line)
+                        offset += len(line)
+                        if len(lines) == limit:
+                            return lines, (seg, offset)
+            except FileNotFoundError:
+                pass
+            if seg == self.write_segment:
+                break
+            seg, offset = seg + 1, 0
+        return lines, (seg, offset)
+
+    def ack(self, count, position):
+        seg, offset = position
+        for done in range(self.read_segment, seg):
+            try:
+                os.remove(self._file(done))
+            except FileNotFoundError:
+                pass
+        self.read_segment, self.read_offset = seg, offset
+        self.records -= count
+        if not self.records and self.writer is not None and seg == self.write_segment:
+            # Everything written has been sent: start a fresh segment.
+            self.writer.close()
+            self.writer = None
+            os.remove(self._file(seg))
+            self.write_segment = self.read_segment = seg + 1
+            self.read_offset = 0
+        self._save_cursor()
+
+
+class AsyncUplink:
+    # Decouples the aggregator from the network. submit() only ever touches
+    # memory or the local spool: summaries wait in a bounded in-memory queue
+    # for the sender thread, which writes them to central in batches. Once
+    # central is unreachable (or the queue overflows) everything goes to the
+    # spool instead, which the sender replays in order, with backoff, before
+    # it takes anything from memory again. Records in the spool are always
+    # older than those in memory, so central sees summaries in the order
+    # they were submitted.
+
+    def __init__(self, spool_path, maxsize=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.spool = SegmentSpool(spool_path)
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.down = len(self.spool) > 0
+        self.sent = 0
+        self.spilled = 0
+        self.thread = threading.Thread(target=self._run, name='uplink', daemon=True)
+        self.thread.start()
+        if self.down:
+            uplink_logger.info(f"Replaying {len(self.spool)} spooled summaries from {spool_path}")
+
+    def submit(self, payloads):
+        lines = [central_client.codec.encode(p) + b'\n' for p in payloads]
+        with self.lock:
+            if self.down or len(self.pending) + len(lines) > self.maxsize:
+                self._spill(lines)
+            else:
+                self.pending.extend(lines)
+            self.wakeup.notify()
+
+    def _spill(self, lines):
+        # Caller holds the lock. Memory goes first so the order is kept.
+        if self.pending:
+            lines = list(self.pending) + lines
+            self.pending.clear()
+        self.spool.append(lines)
+        self.spilled += len(lines)
+        self.down = True
+
+    def _send(self, lines):
+        central_client.uplink.send_data(b''.join(lines))
+
+    def _run(self):
+        delay = RETRY_MIN
+        while True:
+            with self.lock:
+                while not self.pending and not len(self.spool):
+                    self.wakeup.wait()
+                from_spool = len(self.spool) > 0
+                if from_spool:
+                    lines, position = self.spool.peek(self.batch_size)
+                    if not lines:
+                        # Counted records are gone (spool files removed by hand).
+                        self.spool.records = 0
+                        self.down = False
+                        continue
+                else:
+                    lines = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+            try:
+                self._send(lines)
+            except OSError as e:
+                with self.lock:
+                    if not from_spool:
+                        # The failed batch is older than anything left in memory.
+                        self.pending.extendleft(reversed(lines))
+                        self._spill([])
+                    queued = len(self.spool)
+                uplink_logger.warning(f"Central unreachable ({e}); {queued} summaries spooled, "
+                                      f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+
+            delay = RETRY_MIN
+            with self.lock:
+                self.sent += len(lines)
+                if from_spool:
+                    self.spool.ack(len(lines), position)
+                    if not len(self.spool):
+                        self.down = False
+                        uplink_logger.info("Spool drained, central is reachable again")
+
+    def stats(self):
+        with self.lock:
+            return {'queued': len(self.pending), 'spooled': len(self.spool), 'sent': self.sent,
+                    'spilled': self.spilled, 'down': self.down}
+
+
+spool_dir = SPOOL_DIR
+spool_name = 'main'
+queue_size = QUEUE_SIZE
+_uplinks = {}
+_uplinks_lock = threading.Lock()
+
+def configure(directory=SPOOL_DIR, name='main', maxsize=QUEUE_SIZE):
+    global spool_dir, spool_name, queue_size
+    spool_dir = directory
+    spool_name = name
+    queue_size = maxsize
+
+def get_uplink():
+    # One uplink (sender thread and spool directory) per process: threads do
+    # not survive fork, and two processes must never share a spool.
+    pid = os.getpid()
+    uplink = _uplinks.get(pid)
+    if uplink is None:
+        with _uplinks_lock:
+            uplink = _uplinks.get(pid)
+            if uplink is None:
+                uplink = _uplinks[pid] = AsyncUplink(os.path.join(spool_dir, spool_name), queue_size)
+    return uplink
+
+def submit(payloads):
+    get_uplink().submit(payloads)
+
+def stats():
+    uplink = _uplinks.get(os.getpid())
+    return uplink.stats() if uplink is not None else None
@@ -1,5 +1,192 @@
 import os
+import time
+import atexit
+import fnmatch
 import logging
+import threading
+import queue
+
+# Queue mode: records are handed to one background writer thread that
+# writes them in batches and flushes each file once per batch, so callers
+# never wait on disk. Off by default; turned on with configure().
+ASYNC = False
+# Whether console() prints to stdout.
+PRINTS = True
+WRITER_BATCH = 1000
+# Unless a full batch is already waiting, the writer pauses this long after
+# the first record so records pile up instead of waking it (and taking the
+# GIL) for each one.
+WRITER_DELAY = 0.05
+
+loggers = {}
+limits = {}
+
+
+class BufferedFileHandler(logging.FileHandler):
+    # Writes without flushing; the async writer flushes once per batch.
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncWriter:
+    # The single background thread behind every logger in queue mode.
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.pid = os.getpid()
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, handler, record):
+        self.queue.put((handler, record))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.queue.qsize() < WRITER_BATCH:
+                time.sleep(WRITER_DELAY)
+            batch = [item]
+            while len(batch) < WRITER_BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write(batch)
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        touched = set()
+        for handler, record in batch:
+            if record is None:
+                # The logger was closed; records queued before that are done.
+                touched.discard(handler)
+                handler.close()
+                continue
+            handler.handle(record)
+            touched.add(handler)
+        for handler in touched:
+            handler.flush()
+        self.written += len(batch)
+
+    def stop(self, timeout=5.0):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    # Threads do not survive fork, so each process starts its own writer.
+    global _writer
+    if _writer is None or _writer.pid != os.getpid():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = AsyncWriter()
+    return _writer
+
+@atexit.register
+def _drain():
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.stop()
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, target):
+        super().__init__(target.level)
+        self.target = target
+
+    def emit(self, record):
+        # Messages are f-strings already; resolve %-args here so the record
+        # does not hold on to mutable arguments.
+        record.msg = record.getMessage()
+        record.args = None
+        get_writer().put(self.target, record)
+
+    def close(self):
+        get_writer().put(self.target, None)
+        super().close()
+
+
+class Throttle(logging.Filter):
+    # Sampling and rate limiting for INFO and below; warnings and errors
+    # always pass. sample=N keeps one record in N, rate=R allows at most R
+    # records per second (with a burst of R). Suppressed records are counted
+    # and reported on the next record that gets through.
+
+    def __init__(self, sample=None, rate=None):
+        super().__init__()
+        self.sample = sample if sample and sample > 1 else None
+        self.rate = rate if rate and rate > 0 else None
+        self.seen = 0
+        self.tokens = rate or 0.0
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        with self.lock:
+            self.seen += 1
+            keep = self.sample is None or self.seen % self.sample == 1
+            if keep and self.rate is not None:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                else:
+                    keep = False
+            if not keep:
+                self.suppressed += 1
+                return False
+            if self.suppressed:
+                record.msg = f"{record.getMessage()} [{self.suppressed} similar suppressed]"
+                record.args = None
+                self.suppressed = 0
+        return True
+
+
+def _limits_for(name):
+    found = {}
+    for pattern, opts in limits.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            found = opts
+    return found
+
+def _attach(logger, log_file):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    for f in list(logger.filters):
+        logger.removeFilter(f)
+
+    formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
+    if ASYNC:
+        target = BufferedFileHandler(log_file, mode='a', encoding='utf-8')
+        target.setFormatter(formatter)
+        handler = QueueHandler(target)
+    else:
+        handler = logging.FileHandler(log_file, mode='a', encoding='utf-8')
+        handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    opts = _limits_for(logger.name)
+    if opts.get('sample') or opts.get('rate'):
+        logger.addFilter(Throttle(opts.get('sample'), opts.get('rate')))
 
 def setup_logger(name, log_file, level=logging.INFO):
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
@@ -8,11 +195,67 @@ def setup_logger(name, log_file, level=logging.INFO):
     logger.setLevel(level)
 
     logger.handlers.clear()
-
-    handler = logging.FileHandler(log_file, mode='a', encoding='utf-8')
-    formatter = logging.Formatter('%(asctime)s — %(levelname)s — %(message)s')
-    handler.setFormatter(formatter)
-
-    logger.addHandler(handler)
+    _attach(logger, log_file)
     logger.propagate = False
+    loggers[name] = (logger, log_file)
     return logger
+
+def release_files(name):
+    # Close the logger's file but keep it usable: the handler reopens the
+    # file (in append mode) the next time it writes.
+    entry = loggers.get(name)
+    if entry is not None:
+        for handler in entry[0].handlers:
+            handler.close()
+
+def close_logger(name):
+    # Close the logger's file and forget the logger altogether, so that
+    # loggers for short-lived names do not pile up in the logging module.
+    entry = loggers.pop(name, None)
+    if entry is None:
+        return
+    logger = entry[0]
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logging.Logger.manager.loggerDict.pop(name, None)
+
+def set_limits(pattern, sample=None, rate=None):
+    # Sampling/rate limit for INFO records of every logger whose name
+    # matches the glob pattern; later patterns win. Applies to loggers that
+    # already exist as well as ones created later.
+    limits[pattern] = {'sample': sample, 'rate': rate}
+    for name, (logger, log_file) in list(loggers.items()):
+        if fnmatch.fnmatchcase(name, pattern):
+            _attach(logger, log_file)
+
+def configure(async_mode=None, prints=None):
+    # Switch queue mode on or off; loggers created before the switch are
+    # rewired so module-level loggers follow the setting too.
+    global ASYNC, PRINTS
+    if prints is not None:
+        PRINTS = prints
+    if async_mode is not None and async_mode != ASYNC:
+        ASYNC = async_mode
+        for logger, log_file in list(loggers.values()):
+            _attach(logger, log_file)
+
+def console(*args):
+    if PRINTS:
+        print(*args)
+
+def add_arguments(parser):
+    group = parser.add_argument_group('logging')
+    group.add_argument('--log-async', action='store_true',
+                       help='Write log files from one background thread instead of on the caller')
+    group.add_argument('--log-sample', type=int, default=None,
+                       help='Keep only one in N INFO lines of the per-reading loggers')
+    group.add_argument('--log-rate', type=float, default=None,
+                       help='At most this many INFO lines per second per per-reading logger')
+    group.add_argument('--quiet', action='store_true', help='Do not print progress to stdout')
+
+def apply_arguments(args, hot_loggers=('*',)):
+    configure(async_mode=args.log_async, prints=not args.quiet)
+    if args.log_sample or args.log_rate:
+        for pattern in hot_loggers:
+            set_limits(pattern, args.log_sample, args.log_rate)